@@ -14,6 +14,7 @@
 #    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
 
 import _arguments
+import _profile
 import importlib
 import sys
 
@@ -28,9 +29,19 @@ if __name__ == "__main__":
             print("Error: Survey database is not available.")
             sys.exit(1)
 
+    if args.profile:
+        _profile.enable(cprofile=args.cprofile)
+
+    # A failed command exits non-zero, eg for check to fail a CI run.
+    succeeded = False
     try:
-        module.main(args)
+        with _profile.phase(args.command, subcommand=True):
+            succeeded = module.main(args) is not False
     except RuntimeError as ex:
         print(f"Error: {ex}")
     finally:
+        if args.profile:
+            _profile.report(args.profile_output, args.command)
         print("Have a nice day.")
+    if not succeeded:
+        sys.exit(1)
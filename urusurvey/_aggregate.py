@@ -0,0 +1,321 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import abc
+import collections
+import itertools
+
+from _constants import *
+from _utils import *
+import _counts
+
+class SessionFilter:
+    """The sessions that picked any of the values of every (question, values) condition.
+
+    The sessions are found by semi-joins through the response_items index, so a value is
+    matched against single answers and multiple choices alike. They are kept in an indexed
+    temp table for the queries of filtered sources to join against.
+    """
+
+    _table_ids = itertools.count()
+
+    def __init__(self, db, conditions):
+        self.db = db
+        self.conditions = conditions
+        self._table = None
+
+    @classmethod
+    def parse(cls, db, where):
+        """Makes a filter of (question, value) pairs, values for the same question being alternatives"""
+        values = collections.defaultdict(set)
+        for question, value in where:
+            values[question].add(value)
+        return cls(db, [(question, frozenset(i)) for question, i in values.items()])
+
+    def narrowed(self, question, value):
+        return SessionFilter(self.db, [*self.conditions, (question, frozenset((value,)))])
+
+    def __str__(self):
+        return ", ".join(f"Q{question}: {' or '.join(sorted(values))}" for question, values in self.conditions)
+
+    def empty(self):
+        """Whether no session matches at all"""
+        return fetch_result(self.db, f"SELECT NOT EXISTS (SELECT 1 FROM {self.table});")[0] == 1
+
+    @property
+    def query(self):
+        """The (query, params) selecting the matching sessions"""
+        selects, params = [], []
+        for question, values in self.conditions:
+            selects.append(f"""SELECT responses.session
+                               FROM response_items
+                               JOIN responses ON responses.idx = response_items.response_idx
+                               WHERE response_items.question = ? AND
+                                     response_items.value IN ({", ".join("?" * len(values))})""")
+            params.extend((question, *sorted(values)))
+        return " INTERSECT ".join(selects), params
+
+    @property
+    def table(self):
+        if self._table is None:
+            query, params = self.query
+            name = f"session_filter_{next(self._table_ids)}"
+            started = not self.db.in_transaction
+            self.db.execute(f"CREATE TEMP TABLE {name} (idx INTEGER PRIMARY KEY);")
+            self.db.execute(f"INSERT INTO temp.{name} {query};", params)
+            # Don't hold on to a read lock of the survey db because of a temp table.
+            if started:
+                self.db.commit()
+            self._table = f"temp.{name}"
+        return self._table
+
+session_timeline_query = """SELECT submitted / :size * :size AS bucket, COUNT(*)
+                             FROM sessions
+                             WHERE submitted IS NOT NULL AND {in_sessions}
+                             GROUP BY bucket;"""
+
+choice_timeline_query = """SELECT sessions.submitted / :size * :size AS bucket,
+                                  response_items.value,
+                                  COUNT(DISTINCT response_items.response_idx)
+                           FROM response_items
+                           JOIN responses ON responses.idx = response_items.response_idx
+                           JOIN sessions ON sessions.idx = responses.session
+                           WHERE response_items.question = :question AND
+                                 sessions.submitted IS NOT NULL AND
+                                 {in_sessions}
+                           GROUP BY bucket, response_items.value;"""
+
+class GraphSource(abc.ABC):
+    """Everything a graph may ask of its data, whichever way it is stored.
+
+    Values are effective values, "" being no answer, and choices the trimmed ';' separated
+    parts of them.
+    """
+
+    @abc.abstractmethod
+    def value_counts(self, question):
+        """Counts the responses to `question` by value"""
+
+    @abc.abstractmethod
+    def choice_counts(self, question):
+        """Counts the responses to `question` picking each choice"""
+
+    @abc.abstractmethod
+    def response_count(self, question):
+        """Counts the responses to `question`"""
+
+    @abc.abstractmethod
+    def question_text(self, question):
+        pass
+
+    @abc.abstractmethod
+    def crosstab(self, *questions):
+        """Counts every combination of answers to `questions` by sessions answering the first"""
+
+    @abc.abstractmethod
+    def pair_counts(self, parent, child):
+        pass
+
+    @abc.abstractmethod
+    def session_timeline(self, size):
+        pass
+
+    @abc.abstractmethod
+    def choice_timeline(self, question, size):
+        pass
+
+class DatabaseSource(GraphSource):
+    """Answers graph data queries straight from the database, one query at a time.
+
+    With a SessionFilter, only the sessions it matches are counted. The answer counts are
+    of every session, so the counts are grouped from the responses instead.
+    """
+
+    def __init__(self, db, where=None):
+        self.db = db
+        self.where = where
+
+    def in_sessions(self, column):
+        return "1" if self.where is None else f"{column} IN {self.where.table}"
+
+    def value_counts(self, question):
+        if self.where is not None:
+            q = f"""SELECT value, COUNT(*)
+                    FROM effective_responses
+                    WHERE question = ? AND value != '' AND {self.in_sessions("session")}
+                    GROUP BY value;"""
+        else:
+            q = "SELECT value, count FROM answer_counts WHERE question = ? AND count > 0;"
+        return fetch_mapping(self.db, q, (question,))
+
+    def choice_counts(self, question):
+        if self.where is not None:
+            q = f"""SELECT response_items.value, COUNT(DISTINCT response_items.response_idx)
+                    FROM response_items
+                    JOIN responses ON responses.idx = response_items.response_idx
+                    WHERE response_items.question = ? AND {self.in_sessions("responses.session")}
+                    GROUP BY response_items.value;"""
+        else:
+            q = "SELECT value, respondents FROM answer_counts WHERE question = ? AND respondents > 0;"
+        return fetch_mapping(self.db, q, (question,))
+
+    def response_count(self, question):
+        if self.where is not None:
+            return sum(self.value_counts(question).values())
+        q = "SELECT IFNULL(SUM(count), 0) FROM answer_counts WHERE question = ?;"
+        return fetch_result(self.db, q, (question,))[0]
+
+    def question_text(self, question):
+        result = fetch_result(self.db, "SELECT value FROM questions WHERE idx = ?;", (question,))
+        if result is None:
+            raise RuntimeError(f"Could not get question {question}")
+        return result[0]
+
+    def crosstab_query(self, count):
+        """The crosstab query of `count` questions, taking the other questions then the first"""
+        columns, joins = [], []
+        for i in range(count):
+            columns.append(f"IFNULL(IIF(r{i}.flags & {int(ResponseFlags.sanitized)}, s{i}.value, r{i}.value), '')")
+            if i:
+                joins.append(f"LEFT JOIN responses r{i} ON r{i}.question = ? AND r{i}.session = r0.session")
+            joins.append(f"LEFT JOIN sanitize s{i} ON s{i}.idx = r{i}.idx")
+        return f"""SELECT {", ".join(columns)}, COUNT(*)
+                FROM responses r0
+                {" ".join(joins)}
+                WHERE r0.question = ? AND {self.in_sessions("r0.session")}
+                GROUP BY {", ".join(str(i + 1) for i in range(count))};"""
+
+    def crosstab(self, *questions):
+        """Counts every combination of effective answers to `questions` in one grouped query.
+
+        Only sessions answering the first question are counted, "" being no answer.
+        """
+        q = self.crosstab_query(len(questions))
+        return collections.Counter({ tuple(i[:-1]): i[-1]
+                                     for i in iter_results(self.db, q, (*questions[1:], questions[0])) })
+
+    def pair_counts(self, parent, child):
+        """Counts the (parent, child) effective value pairs of every session answering `parent`"""
+        return self.crosstab(parent, child)
+
+    def session_timeline(self, size):
+        """Counts the sessions submitted in every `size` seconds long bucket, by bucket start"""
+        q = session_timeline_query.format(in_sessions=self.in_sessions("idx"))
+        return fetch_mapping(self.db, q, { "size": size })
+
+    def choice_timeline(self, question, size):
+        """Counts the responses picking each choice of `question` by (bucket start, choice)"""
+        q = choice_timeline_query.format(in_sessions=self.in_sessions("responses.session"))
+        return collections.Counter({ (i[0], i[1]): i[2]
+                                     for i in iter_results(self.db, q, { "question": question, "size": size }) })
+
+class Aggregates(DatabaseSource):
+    """Collects everything the graphs need from a single scan over the effective responses"""
+
+    def __init__(self, db, pairs=(), where=None):
+        self._setup(db, pairs, where)
+        self._store(*_counts.tally(self._scan()))
+
+    @classmethod
+    def segmented(cls, db, question, pairs=(), where=None):
+        """Aggregates of the sessions picking each answer to `question`, all from one scan.
+
+        A session picking several choices counts towards each of them.
+        """
+        segments, tallies = {}, {}
+        for session_values in _iter_sessions(db, where):
+            for choice in _counts.split_choices(session_values.get(question) or ""):
+                segment = segments.get(choice)
+                if segment is None:
+                    # Whatever isn't collected here is queried for, so it needs the same filter.
+                    segment = segments[choice] = cls.__new__(cls)
+                    segment._setup(db, pairs, (where or SessionFilter(db, [])).narrowed(question, choice))
+                    tallies[choice] = (collections.Counter(), collections.Counter())
+                segment._tally_pairs(session_values)
+                _counts.tally(session_values.items(), 1, *tallies[choice])
+        for choice, segment in segments.items():
+            segment._store(*tallies[choice])
+        return dict(sorted(segments.items()))
+
+    def _setup(self, db, pairs, where):
+        super().__init__(db, where)
+        self._pairs = { pair: collections.Counter() for pair in pairs }
+        self._values = collections.defaultdict(dict)
+        self._choices = collections.defaultdict(dict)
+
+    def _store(self, counts, respondents):
+        for (question, value), count in counts.items():
+            self._values[question][value] = count
+        for (question, value), count in respondents.items():
+            self._choices[question][value] = count
+
+    def _scan(self):
+        parents = { parent for parent, _ in self._pairs }
+        children = { child for _, child in self._pairs }
+
+        current_session, session_values = None, {}
+        for response in iter_results(self.db, scan_query(self)):
+            if response["session"] != current_session:
+                self._tally_pairs(session_values)
+                current_session, session_values = response["session"], {}
+
+            value = _counts.effective_value(response["flags"], response["original"], response["sanitized"])
+            if response["question"] in parents or response["question"] in children:
+                session_values[response["question"]] = value
+            yield response["question"], value
+        self._tally_pairs(session_values)
+
+    def _tally_pairs(self, session_values):
+        for (parent, child), counter in self._pairs.items():
+            if parent in session_values:
+                counter[session_values[parent], session_values.get(child) or ""] += 1
+
+    def value_counts(self, question):
+        return self._values.get(question, {})
+
+    def choice_counts(self, question):
+        return self._choices.get(question, {})
+
+    def response_count(self, question):
+        return sum(self.value_counts(question).values())
+
+    def pair_counts(self, parent, child):
+        if (parent, child) in self._pairs:
+            return self._pairs[parent, child]
+        return super().pair_counts(parent, child)
+
+def scan_query(source):
+    return f"""SELECT session,
+                      question,
+                      flags,
+                      responses.value AS original,
+                      sanitize.value AS sanitized
+               FROM responses
+               LEFT JOIN sanitize ON sanitize.idx = responses.idx
+               WHERE {source.in_sessions("session")}
+               ORDER BY session;"""
+
+def _iter_sessions(db, where=None):
+    """Yields the effective answers of every session matching `where` as a question to value dict"""
+    current_session, session_values = None, {}
+    for response in iter_results(db, scan_query(DatabaseSource(db, where))):
+        if response["session"] != current_session:
+            if session_values:
+                yield session_values
+            current_session, session_values = response["session"], {}
+        session_values[response["question"]] = _counts.effective_value(response["flags"], response["original"],
+                                                                       response["sanitized"])
+    if session_values:
+        yield session_values
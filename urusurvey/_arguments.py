@@ -17,21 +17,79 @@ import argparse
 from pathlib import Path
 
 program_description = "Uru Survey"
+
+def _condition(value):
+    question, separator, answer = value.partition("=")
+    if not separator or not question.strip().isdigit() or not answer.strip():
+        raise argparse.ArgumentTypeError(f"'{value}' is not a QUESTION=VALUE condition, eg 4=Mac")
+    return int(question), answer.strip()
+
 main_parser = argparse.ArgumentParser(description=program_description)
 main_parser.add_argument("--db-path", type=Path, help="survey database file", default="uru_survey.db")
+main_parser.add_argument("--profile", action="store_true", help="write per phase and per query timings to the profile output")
+main_parser.add_argument("--profile-output", type=Path, default=Path("profile.json"), help="JSON file to write the profile to")
+main_parser.add_argument("--cprofile", action="store_true", help="capture a cProfile of the slowest subcommand when profiling")
+
+# Options of the commands that only ever read the survey database
+read_only_parser = argparse.ArgumentParser(add_help=False)
+read_only_parser.add_argument("--read-only", action="store_true", help="open the survey database read only, without upgrading it")
+read_only_parser.add_argument("--immutable", action="store_true", help="like --read-only, but promise that nothing writes to the database meanwhile so it can be read without locking")
 
 sub_parsers = main_parser.add_subparsers(title="command", dest="command", required=True)
 
+# Benchmark command
+benchmark_parser = sub_parsers.add_parser("benchmark")
+benchmark_parser.add_argument("--sizes", default="1000,100000,1000000", help="comma separated session counts to benchmark")
+benchmark_parser.add_argument("--work-dir", type=Path, help="directory to keep the generated surveys in, defaults to a temporary one")
+benchmark_parser.add_argument("--seed", type=int, default=0, help="seed for the generated surveys")
+benchmark_parser.add_argument("--output", type=Path, default=Path("benchmark.json"), help="JSON file to write the timings to")
+
+# Check command
+check_parser = sub_parsers.add_parser("check")
+check_parser.add_argument("--rebuild", action="store_true", help="recompute the answer counts, search index and response items from scratch")
+
+# Generate command
+generate_parser = sub_parsers.add_parser("generate")
+generate_parser.add_argument("-n", "--sessions", type=int, default=1000, help="number of sessions to generate")
+generate_parser.add_argument("--append", action="store_true", help="add the sessions to the end of an existing survey")
+generate_parser.add_argument("--seed", type=int, default=0, help="seed for the random answers")
+generate_parser.add_argument("--multi-density", type=float, default=0.3, help="chance of each choice being picked in a multiple choice answer")
+generate_parser.add_argument("--free-text-cardinality", type=int, default=1000, help="number of distinct answers to each free text question")
+generate_parser.add_argument("--empty-rate", type=float, default=0.1, help="chance of an answer being left empty")
+generate_parser.add_argument("csv_path", type=Path, help="survey csv file to write")
+
 # Graph command
-graph_parser = sub_parsers.add_parser("graph")
+graph_parser = sub_parsers.add_parser("graph", parents=[read_only_parser])
+graph_parser.add_argument("--snapshot", action="store_true", help="copy the whole database into memory before collecting any data")
 graph_parser.add_argument("--output", type=Path, help="path to output the graph")
+graph_parser.add_argument("--dashboard", action="store_true",
+                          help="'all' writes one index page sharing a single plotly.js instead of standalone pages")
+graph_parser.add_argument("--matrix", action="store_true",
+                          help="'all' and --segment load the responses into a numpy matrix instead of tallying them in python")
+graph_parser.add_argument("--force", action="store_true", help="redraw every graph, even if it is unchanged")
+graph_parser.add_argument("-j", "--jobs", type=int, default=1, help="number of processes rendering graphs for 'all'")
+graph_parser.add_argument("--questions", type=lambda x: [int(i) for i in x.split(",")],
+                          help="comma separated question indices, outermost first, for 'crosstab', or the one question for 'timeline'")
+graph_parser.add_argument("--where", type=_condition, action="append", default=[], metavar="QUESTION=VALUE",
+                          help="only draw the sessions with this answer, repeat for several; values for the same question are alternatives")
+graph_parser.add_argument("--segment", type=int, metavar="QUESTION",
+                          help="draw the graph once for the sessions picking each answer to this question")
+graph_parser.add_argument("--bucket", choices=["day", "hour"], default="day", help="time span 'timeline' groups the responses by")
+graph_parser.add_argument("--table", action="store_true", help="'crosstab' prints a table instead of a graph")
 graph_parser.add_argument("subcommand", type=str.lower, nargs="?")
 
+# Load test command
+loadtest_parser = sub_parsers.add_parser("loadtest")
+loadtest_parser.add_argument("--url", default="http://127.0.0.1:8000", help="address of a running serve command")
+loadtest_parser.add_argument("-n", "--requests", type=int, default=1000, help="total number of requests to send")
+loadtest_parser.add_argument("-c", "--concurrency", type=int, default=8, help="number of requests in flight at once")
+loadtest_parser.add_argument("paths", nargs="*", help="paths to request in turn, defaults to the JSON of every graph")
+
 # Question command
-question_parser = sub_parsers.add_parser("questions")
+question_parser = sub_parsers.add_parser("questions", parents=[read_only_parser])
 
 # Response command
-response_parser = sub_parsers.add_parser("response")
+response_parser = sub_parsers.add_parser("response", parents=[read_only_parser])
 response_parser.add_argument("-q", "--question", type=int, default=-1)
 response_parser.add_argument("session", type=int, help="session index to view responses for")
 
@@ -41,8 +99,40 @@ sanitize_parser.add_argument("--all", action="store_true", help="displays respon
 sanitize_method = sanitize_parser.add_mutually_exclusive_group()
 sanitize_method.add_argument("-q", "--question", action="store_true", help="sanitize responses by question index")
 sanitize_method.add_argument("-s", "--session", action="store_true", help="sanitize responses by session index")
+sanitize_method.add_argument("-r", "--rules", type=Path, help="apply a sanitize rules file to every pending response")
+sanitize_method.add_argument("--suggest", action="store_true",
+                             help="propose merging similarly spelled responses to the question index")
+sanitize_parser.add_argument("-m", "--moderator", help="name to claim responses under, defaults to user@host:pid")
+sanitize_parser.add_argument("--dry-run", action="store_true", help="with --rules, only print what would change")
+sanitize_parser.add_argument("-g", "--group", action="store_true",
+                             help="with --question, handle identical pending responses together")
 sanitize_parser.add_argument("-i", "--index", type=int, default=-1)
 
+# Search command
+search_parser = sub_parsers.add_parser("search")
+search_parser.add_argument("-q", "--question", type=int, default=-1, help="only search responses to this question index")
+search_parser.add_argument("--sanitized", action="store_true", help="include responses that were sanitized")
+search_parser.add_argument("--valid", action="store_true", help="include responses that were verified as valid")
+search_parser.add_argument("--pending", action="store_true", help="include responses that were not moderated yet")
+search_parser.add_argument("-n", "--limit", type=int, default=50, help="maximum number of responses to show")
+search_parser.add_argument("match", help="full text query, eg 'deep AND island' or 'teledah*'")
+
+# Serve command
+serve_parser = sub_parsers.add_parser("serve")
+serve_parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+serve_parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+serve_parser.add_argument("-v", "--verbose", action="store_true", help="log every request")
+
 # Update command
 update_parser = sub_parsers.add_parser("update")
+update_parser.add_argument("--rules", type=Path, help="sanitize rules file to apply to the new responses")
+update_parser.add_argument("--full", action="store_true", help="reimport every row instead of only the new ones")
 update_parser.add_argument("csv_path", type=Path, help="survey csv file from google sheets")
+
+# Watch command
+watch_parser = sub_parsers.add_parser("watch")
+watch_parser.add_argument("--output", type=Path, help="path to output the graphs")
+watch_parser.add_argument("--rules", type=Path, help="sanitize rules file to apply to the new responses")
+watch_parser.add_argument("--interval", type=float, default=1.0, help="seconds between checks of the csv file")
+watch_parser.add_argument("--debounce", type=float, default=2.0, help="seconds the csv has to stay unchanged before importing")
+watch_parser.add_argument("csv_path", type=Path, help="survey csv file from google sheets")
@@ -0,0 +1,101 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import re
+
+# Edit distance allowed between two normalized values, relative to the longer one.
+max_distance_ratio = 0.25
+
+# Grams shared by more values than this say nothing about similarity and would make the
+# comparisons quadratic again, so they are not used for blocking.
+max_gram_values = 500
+
+_strip_punctuation = re.compile(r"[^\w\s]")
+
+def normalize(value):
+    return " ".join(_strip_punctuation.sub(" ", value.casefold()).split())
+
+def _grams(key, n=3):
+    padded = f"  {key} "
+    return { padded[i:i+n] for i in range(len(padded) - n + 1) }
+
+def _edit_distance(a, b, limit):
+    """Levenshtein distance between `a` and `b`, or `limit` + 1 if it is larger than `limit`"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, x in enumerate(a, start=1):
+        current = [i]
+        for j, y in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (x != y)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+_digits = re.compile(r"\d+")
+
+def cluster_values(counts):
+    """Groups the values of `counts` (value -> number of responses) that are probably the same.
+
+    Values are first grouped by their normalized form. Going from the most common normalized
+    form down, each one then joins the closest cluster whose canonical form is within the edit
+    distance and has the same numbers, or starts a cluster of its own. Only canonical forms
+    sharing character trigrams are ever compared, and never one member against another, so
+    "3ds Max 2010" doesn't end up with "3ds Max 2021" by way of a chain of near matches.
+    Returns (canonical value, { value: count }) for every group of more than one value, the
+    canonical value being the most common spelling, largest groups first.
+    """
+    by_key = collections.defaultdict(dict)
+    for value, count in counts.items():
+        by_key[normalize(value)][value] = count
+    keys = sorted(by_key.keys(), key=lambda x: (-sum(by_key[x].values()), x))
+
+    canonicals, postings = [], collections.defaultdict(list)
+    members = collections.defaultdict(list)
+    for key in keys:
+        grams, digits = _grams(key), _digits.findall(key)
+        shared = collections.Counter()
+        for gram in grams:
+            posting = postings[gram]
+            if len(posting) <= max_gram_values:
+                shared.update(posting)
+
+        best = None
+        for i, count in shared.items():
+            canonical, canonical_grams, canonical_digits = canonicals[i]
+            if digits != canonical_digits:
+                continue
+            # A single edit touches at most three grams, so a near match shares most of them.
+            limit = max(1, int(max(len(key), len(canonical)) * max_distance_ratio))
+            if count < max(len(grams), len(canonical_grams)) - 3 * limit:
+                continue
+            distance = _edit_distance(key, canonical, limit)
+            if distance <= limit and (best is None or distance < best[0]):
+                best = (distance, i)
+
+        if best is None:
+            best = (0, len(canonicals))
+            canonicals.append((key, grams, digits))
+            for gram in grams:
+                postings[gram].append(best[1])
+        members[best[1]].append(key)
+
+    groups = [{ value: count for key in cluster for value, count in by_key[key].items() }
+              for cluster in members.values()]
+    result = [(max(group.items(), key=lambda x: (x[1], x[0]))[0], group) for group in groups if len(group) > 1]
+    result.sort(key=lambda x: (-sum(x[1].values()), x[0]))
+    return result
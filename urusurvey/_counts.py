@@ -0,0 +1,102 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+
+from _constants import *
+from _utils import *
+
+def effective_value(flags, original, sanitized):
+    return sanitized if flags & ResponseFlags.sanitized else original
+
+def split_choices(value):
+    """The distinct trimmed ';' separated choices of `value`, matching the response_items table"""
+    return { i for i in (j.strip(" \t\r\n") for j in value.split(";")) if i }
+
+def tally(values, sign=1, counts=None, respondents=None):
+    if counts is None:
+        counts = collections.Counter()
+    if respondents is None:
+        respondents = collections.Counter()
+    for question, value in values:
+        if not value:
+            continue
+        counts[question, value] += sign
+        for choice in split_choices(value):
+            respondents[question, choice] += sign
+    return counts, respondents
+
+_effective_values_query = """SELECT question,
+                                  flags,
+                                  responses.value AS original,
+                                  sanitize.value AS sanitized
+                           FROM responses
+                           LEFT JOIN sanitize ON sanitize.idx = responses.idx;"""
+
+# The SQL counterpart of split_choices(): quoted as a JSON string, replacing the separators turns
+# `value` into a JSON array for json_each() to split.
+choices_json = """'[' || replace(json_quote({value}), ';', '","') || ']'"""
+trimmed_choice = "trim(choices.value, char(32, 9, 10, 13))"
+
+# Adds (or with sign "-" removes) the effective responses matching `where` to the answer counts,
+# the SQL counterpart of tally(). Identical responses are grouped first, so only the distinct
+# values are split into their choices. Grouping by +question keeps SQLite from walking the whole
+# responses_question index for its order instead of looking up the responses `where` matches.
+tally_query = f"""
+    INSERT INTO answer_counts (question, value, count, respondents)
+        WITH response_values AS MATERIALIZED
+            (SELECT question, value, COUNT(*) AS count
+             FROM effective_responses
+             WHERE {{where}} AND value != ''
+             GROUP BY +question, value)
+        SELECT question, value, {{sign}}SUM(count), {{sign}}SUM(respondents)
+        FROM (SELECT question, value, count, 0 AS respondents FROM response_values
+              UNION ALL
+              SELECT question, choice, 0, count
+              FROM (SELECT DISTINCT question, response_values.value, {trimmed_choice} AS choice, count
+                    FROM response_values, json_each({choices_json.format(value="response_values.value")}) AS choices)
+              WHERE choice != '')
+        WHERE true
+        GROUP BY question, value
+        ON CONFLICT (question, value) DO UPDATE
+        SET count = count + excluded.count,
+            respondents = respondents + excluded.respondents;"""
+
+# The responses of the sessions being added by update.
+new_sessions_where = "effective_responses.session >= ?"
+
+def add_sessions(db, first_session):
+    """Counts the responses of every session from `first_session` onward"""
+    db.execute(tally_query.format(sign="", where=new_sessions_where), (first_session,))
+
+def rebuild(db):
+    db.execute("DELETE FROM answer_counts;")
+    add_sessions(db, 0)
+
+def recount(db):
+    """Tallies the effective responses in python, independent of the SQL kept answer counts"""
+    return tally((response["question"], effective_value(response["flags"], response["original"],
+                                                        response["sanitized"]))
+                 for response in iter_results(db, _effective_values_query))
+
+def iter_mismatches(db):
+    """Yields (question, value, stored, live) for every answer_counts row that is out of date"""
+    counts, respondents = recount(db)
+    stored = { (i["question"], i["value"]): (i["count"], i["respondents"])
+               for i in iter_results(db, "SELECT * FROM answer_counts;") }
+    for key in sorted(stored.keys() | counts.keys() | respondents.keys()):
+        live = (counts[key], respondents[key])
+        if stored.get(key, (0, 0)) != live:
+            yield (*key, stored.get(key, (0, 0)), live)
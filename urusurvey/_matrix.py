@@ -0,0 +1,172 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import collections
+
+import numpy
+
+from _aggregate import GraphSource
+from _utils import *
+import _counts
+
+class ResponseMatrix(GraphSource):
+    """The effective responses as a sessions x questions matrix of integer category codes.
+
+    Every question has its own dictionary of values, code 0 always being "no answer". The
+    ';' separated choices are derived from the dictionaries on demand as a sparse indicator
+    matrix, stored as parallel (row, choice code) arrays.
+    """
+
+    def __init__(self, sessions, times, codes, dictionaries, questions):
+        self.sessions = sessions
+        self.times = times
+        self.codes = codes
+        self.dictionaries = dictionaries
+        self.questions = questions
+        self._choices = {}
+
+    @classmethod
+    def load(cls, db):
+        sessions, times = array.array("q"), array.array("d")
+        for session in iter_results(db, "SELECT idx, submitted FROM sessions ORDER BY idx;"):
+            sessions.append(session["idx"])
+            times.append(numpy.nan if session["submitted"] is None else session["submitted"])
+        sessions = numpy.array(sessions, dtype=numpy.int64)
+        times = numpy.array(times, dtype=numpy.float64)
+        num_questions = fetch_result(db, "SELECT IFNULL(MAX(idx) + 1, 0) FROM questions;")[0]
+        lookups = [{ "": 0 } for _ in range(num_questions)]
+        questions = [None] * num_questions
+        for question in iter_results(db, "SELECT idx, value FROM questions;"):
+            questions[question["idx"]] = question["value"]
+
+        session_buf, question_buf, code_buf = array.array("q"), array.array("q"), array.array("q")
+        q = """SELECT session,
+                      question,
+                      flags,
+                      responses.value AS original,
+                      sanitize.value AS sanitized
+               FROM responses
+               LEFT JOIN sanitize ON sanitize.idx = responses.idx;"""
+        for response in iter_results(db, q):
+            value = _counts.effective_value(response["flags"], response["original"], response["sanitized"])
+            lookup = lookups[response["question"]]
+            session_buf.append(response["session"])
+            question_buf.append(response["question"])
+            code_buf.append(lookup.setdefault(value or "", len(lookup)))
+
+        dtype = numpy.min_scalar_type(max((len(i) for i in lookups), default=1))
+        codes = numpy.zeros((len(sessions), num_questions), dtype=dtype)
+        rows = numpy.searchsorted(sessions, numpy.frombuffer(session_buf, dtype=numpy.int64))
+        codes[rows, numpy.frombuffer(question_buf, dtype=numpy.int64)] = numpy.frombuffer(code_buf, dtype=numpy.int64)
+        dictionaries = [numpy.array(list(i.keys()), dtype=object) for i in lookups]
+        return cls(sessions, times, codes, dictionaries, questions)
+
+    def filtered(self, mask):
+        """Returns the matrix of only the sessions selected by the boolean `mask`"""
+        return ResponseMatrix(self.sessions[mask], self.times[mask], self.codes[mask], self.dictionaries, self.questions)
+
+    def where(self, question, *values):
+        """Boolean mask of the sessions whose answer to `question` is one of `values`"""
+        lookup = { value: code for code, value in enumerate(self.dictionaries[question]) }
+        wanted = [lookup[i] for i in values if i in lookup]
+        return numpy.isin(self.codes[:, question], wanted)
+
+    def where_chose(self, question, *choices):
+        """Boolean mask of the sessions that picked any of `choices` for `question`"""
+        rows, columns, dictionary = self._choice_indicator(question)
+        lookup = { value: code for code, value in enumerate(dictionary) }
+        wanted = [lookup[i] for i in choices if i in lookup]
+        mask = numpy.zeros(len(self.sessions), dtype=bool)
+        mask[rows[numpy.isin(columns, wanted)]] = True
+        return mask
+
+    def where_all(self, conditions):
+        """Boolean mask of the sessions that picked any of the values of every (question, values) condition"""
+        mask = numpy.ones(len(self.sessions), dtype=bool)
+        for question, values in conditions:
+            mask &= self.where_chose(question, *values)
+        return mask
+
+    def _choice_indicator(self, question):
+        if question not in self._choices:
+            self._choices[question] = self._build_choice_indicator(question)
+        return self._choices[question]
+
+    def _build_choice_indicator(self, question):
+        # Split every distinct value once, then expand the splits to every row using that value.
+        lookup, flat, lengths = {}, [], []
+        for value in self.dictionaries[question]:
+            choices = _counts.split_choices(value) if value else ()
+            flat.extend(lookup.setdefault(i, len(lookup)) for i in choices)
+            lengths.append(len(choices))
+        flat = numpy.array(flat, dtype=numpy.int64)
+        lengths = numpy.array(lengths, dtype=numpy.int64)
+        starts = numpy.cumsum(lengths) - lengths
+
+        codes = self.codes[:, question]
+        row_lengths = lengths[codes]
+        rows = numpy.repeat(numpy.arange(len(codes)), row_lengths)
+        offsets = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(row_lengths) - row_lengths, row_lengths)
+        columns = flat[numpy.repeat(starts[codes], row_lengths) + offsets]
+        return rows, columns, numpy.array(list(lookup.keys()), dtype=object)
+
+    def value_counts(self, question):
+        dictionary = self.dictionaries[question]
+        counts = numpy.bincount(self.codes[:, question], minlength=len(dictionary))
+        return { dictionary[i]: int(counts[i]) for i in numpy.flatnonzero(counts) if i != 0 }
+
+    def choice_counts(self, question):
+        rows, columns, dictionary = self._choice_indicator(question)
+        counts = numpy.bincount(columns, minlength=len(dictionary))
+        return { dictionary[i]: int(counts[i]) for i in numpy.flatnonzero(counts) }
+
+    def response_count(self, question):
+        return int(numpy.count_nonzero(self.codes[:, question]))
+
+    def question_text(self, question):
+        if not 0 <= question < len(self.questions) or self.questions[question] is None:
+            raise RuntimeError(f"Could not get question {question}")
+        return self.questions[question]
+
+    def crosstab(self, *questions):
+        """Counts every combination of answers to `questions`, "" being no answer"""
+        shape = tuple(len(self.dictionaries[i]) for i in questions)
+        combined = numpy.ravel_multi_index(tuple(self.codes[:, i].astype(numpy.int64) for i in questions), shape)
+        keys, counts = numpy.unique(combined, return_counts=True)
+        result = collections.Counter()
+        for key, count in zip(zip(*numpy.unravel_index(keys, shape)), counts):
+            result[tuple(self.dictionaries[q][c] for q, c in zip(questions, key))] = int(count)
+        return result
+
+    def pair_counts(self, parent, child):
+        return self.crosstab(parent, child)
+
+    def _buckets(self, rows, size):
+        times = self.times[rows]
+        valid = ~numpy.isnan(times)
+        return (times[valid] // size * size).astype(numpy.int64), valid
+
+    def session_timeline(self, size):
+        buckets, valid = self._buckets(slice(None), size)
+        keys, counts = numpy.unique(buckets, return_counts=True)
+        return { int(key): int(count) for key, count in zip(keys, counts) }
+
+    def choice_timeline(self, question, size):
+        rows, columns, dictionary = self._choice_indicator(question)
+        buckets, valid = self._buckets(rows, size)
+        keys, counts = numpy.unique(numpy.stack((buckets, columns[valid])), axis=1, return_counts=True)
+        return collections.Counter({ (int(bucket), dictionary[column]): int(count)
+                                     for (bucket, column), count in zip(keys.T, counts) })
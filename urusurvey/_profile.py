@@ -0,0 +1,144 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+from contextlib import contextmanager
+import json
+import sqlite3
+import time
+
+# Only collect anything when asked for, the helpers in _utils check this on every query.
+enabled = False
+
+_cprofile = False
+_phases = {}
+_phase_stack = []
+_profilers = []
+_queries = {}
+
+class _Phase:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.subcommand = False
+        self.leaf = True
+        self.profiler = None
+
+def enable(cprofile=False):
+    global enabled, _cprofile
+    enabled = True
+    _cprofile = cprofile
+
+@contextmanager
+def phase(name, subcommand=False):
+    """Times a phase of the running command, nested phases are named by their path.
+
+    Subcommand phases are candidates for the cProfile capture. Only the innermost ones are
+    considered, as their profiles don't overlap.
+    """
+    if not enabled:
+        yield
+        return
+
+    _phase_stack.append(name)
+    path = "/".join(_phase_stack)
+    record = _phases.setdefault(path, _Phase(path))
+    record.subcommand |= subcommand
+
+    profiler = None
+    if _cprofile and subcommand:
+        import cProfile
+
+        for i in _phases.values():
+            if i.subcommand and path.startswith(f"{i.name}/"):
+                i.leaf = False
+        if _profilers:
+            _profilers[-1].disable()
+        profiler = record.profiler or cProfile.Profile()
+        record.profiler = profiler
+        _profilers.append(profiler)
+        profiler.enable()
+
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        record.calls += 1
+        record.wall += time.perf_counter() - start_wall
+        record.cpu += time.process_time() - start_cpu
+        if profiler is not None:
+            profiler.disable()
+            _profilers.pop()
+            if _profilers:
+                _profilers[-1].enable()
+        _phase_stack.pop()
+
+def record_query(db, query, params, elapsed, rows):
+    record = _queries.get(query)
+    if record is None:
+        record = { "sql": " ".join(query.split()), "calls": 0, "time": 0.0, "rows": 0,
+                   "plan": _explain(db, query, params) }
+        _queries[query] = record
+    record["calls"] += 1
+    record["time"] += elapsed
+    record["rows"] += rows
+
+def _explain(db, query, params):
+    if query.lstrip().upper().startswith("EXPLAIN"):
+        return []
+    try:
+        return [i[3] for i in db.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()]
+    except sqlite3.Error:
+        return []
+
+def _hottest_subcommand():
+    candidates = [i for i in _phases.values() if i.subcommand and i.leaf and i.profiler is not None]
+    return max(candidates, key=lambda x: x.wall, default=None)
+
+def report(path, command):
+    phases = sorted(_phases.values(), key=lambda x: x.name)
+    queries = sorted(_queries.values(), key=lambda x: -x["time"])
+    result = {
+        "command": command,
+        "phases": [{ "name": i.name, "calls": i.calls, "wall": i.wall, "cpu": i.cpu } for i in phases],
+        "queries": queries,
+    }
+
+    hottest = _hottest_subcommand()
+    if hottest is not None:
+        import pstats
+
+        stats_path = path.with_suffix(".prof")
+        hottest.profiler.dump_stats(str(stats_path))
+        result["cprofile"] = { "phase": hottest.name, "file": str(stats_path) }
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+
+    print()
+    print(f"{'PHASE':<48} {'CALLS':>6} {'WALL':>9} {'CPU':>9}")
+    for i in sorted(phases, key=lambda x: -x.wall)[:10]:
+        print(f"{i.name[-48:]:<48} {i.calls:>6} {i.wall:>8.3f}s {i.cpu:>8.3f}s")
+    print()
+    print(f"{'QUERY':<48} {'CALLS':>6} {'TIME':>9} {'ROWS':>9}")
+    for i in queries[:10]:
+        print(f"{i['sql'][:48]:<48} {i['calls']:>6} {i['time']:>8.3f}s {i['rows']:>9}")
+    if hottest is not None:
+        print()
+        print(f"cProfile of '{hottest.name}' ({hottest.wall:.3f}s):")
+        pstats.Stats(hottest.profiler).sort_stats("cumulative").print_stats(15)
+    print(f"Profile written to {path}")
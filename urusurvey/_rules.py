@@ -0,0 +1,107 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import json
+import re
+
+from _constants import *
+from _utils import *
+
+# Rules files map question indices to the rules for that question, eg
+# {
+#     "8": {
+#         "exact": { "Gehn Shard": "Gehn" },
+#         "casefold": { "the gehn shard": "Gehn" },
+#         "regex": [ ["^MO:?UL(a|Again)?$", "MOULa"] ],
+#         "valid": [ "^Deep Island$" ]
+#     }
+# }
+# The first mapping to match rewrites the response. A rewrite to the response itself, or a
+# match of a "valid" pattern, verifies the response instead.
+
+class _QuestionRules:
+    def __init__(self, rules):
+        self.exact = dict(rules.get("exact", {}))
+        self.casefold = { key.casefold(): value for key, value in rules.get("casefold", {}).items() }
+        self.regex = [(re.compile(pattern), replacement) for pattern, replacement in rules.get("regex", [])]
+        self.valid = [re.compile(pattern) for pattern in rules.get("valid", [])]
+
+    def apply(self, value):
+        """Returns the sanitized value, None if `value` is valid as is or False if no rule matched"""
+        sanitized = self.exact.get(value)
+        if sanitized is None:
+            sanitized = self.casefold.get(value.casefold())
+        if sanitized is None:
+            for pattern, replacement in self.regex:
+                if pattern.search(value):
+                    sanitized = pattern.sub(replacement, value).strip()
+                    break
+        if sanitized is None:
+            return None if any(i.search(value) for i in self.valid) else False
+        return None if sanitized == value else sanitized
+
+def load_rules(path):
+    try:
+        with path.open("r", encoding="utf-8") as f:
+            rules = json.load(f)
+        return { int(question): _QuestionRules(i) for question, i in rules.items() }
+    except (OSError, ValueError, re.error) as ex:
+        raise RuntimeError(f"Unable to load sanitize rules from '{path}': {ex}")
+
+pending_query = """SELECT idx, question, value
+                   FROM responses
+                   WHERE question IN ({questions}) AND session >= ? AND flags & ? = 0 AND value != '';"""
+
+def apply_rules(db, rules, first_session=0, dry_run=False):
+    """Applies `rules` to the pending responses of sessions from `first_session` onward.
+
+    Returns a Counter of (question, original, sanitized) changes, sanitized being None for
+    responses that were verified as valid.
+    """
+    changes = collections.Counter()
+    if not rules:
+        return changes
+
+    sanitize, valid = [], []
+    questions = ", ".join(str(i) for i in rules.keys())
+    q = pending_query.format(questions=questions)
+    for response in iter_results(db, q, (first_session, ResponseFlags.sanitized | ResponseFlags.valid)):
+        sanitized = rules[response["question"]].apply(response["value"])
+        if sanitized is False:
+            continue
+        changes[response["question"], response["value"], sanitized] += 1
+        if sanitized is None:
+            valid.append((response["idx"],))
+        else:
+            sanitize.append((response["idx"], sanitized))
+
+    if dry_run:
+        return changes
+
+    db.executemany(f"UPDATE responses SET flags = flags | {int(ResponseFlags.valid)} WHERE idx = ?;", valid)
+    db.executemany("INSERT INTO sanitize (idx, value) VALUES (?, ?);", sanitize)
+    db.executemany(f"UPDATE responses SET flags = flags | {int(ResponseFlags.sanitized)} WHERE idx = ?;",
+                   ((i,) for i, _ in sanitize))
+    return changes
+
+def print_changes(changes):
+    for (question, original, sanitized), count in sorted(changes.items(), key=lambda x: (x[0][0], x[0][1])):
+        if sanitized is None:
+            print(f"Q:{question} VALID    {original!r} ({count})")
+        else:
+            print(f"Q:{question} SANITIZE {original!r} -> {sanitized!r} ({count})")
+    total = sum(changes.values())
+    print(f"{total} responses matched the sanitize rules")
@@ -0,0 +1,306 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+
+from _utils import parse_timestamp
+import _counts
+
+db_schema = """
+CREATE TABLE IF NOT EXISTS responses
+    (idx INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE ON CONFLICT IGNORE NOT NULL,
+     session INTEGER REFERENCES sessions (idx) NOT NULL,
+     question INTEGER REFERENCES questions (idx) NOT NULL,
+     flags INTEGER NOT NULL DEFAULT (0),
+     value TEXT NOT NULL,
+     CONSTRAINT user_response_constraint UNIQUE (session, question) ON CONFLICT IGNORE);
+
+CREATE TABLE IF NOT EXISTS questions
+     (idx INTEGER PRIMARY KEY ON CONFLICT IGNORE AUTOINCREMENT NOT NULL,
+      value TEXT);
+
+CREATE TABLE IF NOT EXISTS sanitize
+    (idx INTEGER PRIMARY KEY ON CONFLICT REPLACE AUTOINCREMENT REFERENCES responses (idx) NOT NULL, 
+     value TEXT NOT NULL);
+
+CREATE TABLE IF NOT EXISTS sessions
+    (idx INTEGER PRIMARY KEY ON CONFLICT IGNORE AUTOINCREMENT NOT NULL,
+     timestamp DATETIME NOT NULL);
+
+CREATE TABLE IF NOT EXISTS import_state
+    (idx INTEGER PRIMARY KEY CHECK (idx = 0),
+     rows INTEGER NOT NULL,
+     offset INTEGER NOT NULL,
+     header_hash TEXT NOT NULL,
+     prefix_hash TEXT NOT NULL);
+"""
+
+def _execute_script(db, script):
+    # Unlike executescript(), this does not commit behind our back, so the migration and
+    # the version bump land in the same transaction.
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            db.execute(statement)
+            statement = ""
+
+def _create_tables(db):
+    _execute_script(db, db_schema)
+
+def _add_response_indexes(db):
+    # Covers the per question scans in graph and sanitize as well as the (question, session)
+    # lookups in the sunburst self joins. Lookups by session are already covered by the
+    # index backing user_response_constraint.
+    db.execute("""CREATE INDEX IF NOT EXISTS responses_question
+                  ON responses (question, session, flags, value);""")
+
+# Answer tallies for the graphs. `count` is the number of responses with exactly this value,
+# `respondents` the number of responses that picked it as one of their ';' separated choices.
+# Like the search index, a sanitize is moved from the old value to the new one by triggers and
+# new sessions are counted in bulk by update.
+_changed_response = "WHEN old.value != new.value OR (old.flags & 1) != (new.flags & 1)"
+_drop_unused_counts = "DELETE FROM answer_counts WHERE question = {question} AND count = 0 AND respondents = 0;"
+
+answer_counts_schema = f"""
+CREATE TABLE IF NOT EXISTS answer_counts
+    (question INTEGER REFERENCES questions (idx) NOT NULL,
+     value TEXT NOT NULL,
+     count INTEGER NOT NULL DEFAULT (0),
+     respondents INTEGER NOT NULL DEFAULT (0),
+     PRIMARY KEY (question, value))
+WITHOUT ROWID;
+
+CREATE VIEW IF NOT EXISTS effective_responses AS
+    SELECT responses.idx AS idx,
+           session,
+           question,
+           flags,
+           IIF(flags & 1, sanitize.value, responses.value) AS value
+    FROM responses
+    LEFT JOIN sanitize ON sanitize.idx = responses.idx;
+
+CREATE TRIGGER IF NOT EXISTS answer_counts_flags_before BEFORE UPDATE OF flags, value ON responses
+{_changed_response}
+BEGIN
+    {_counts.tally_query.format(sign="-", where="effective_responses.idx = old.idx")}
+END;
+
+CREATE TRIGGER IF NOT EXISTS answer_counts_flags AFTER UPDATE OF flags, value ON responses
+{_changed_response}
+BEGIN
+    {_counts.tally_query.format(sign="", where="effective_responses.idx = new.idx")}
+    {_drop_unused_counts.format(question="new.question")}
+END;
+
+CREATE TRIGGER IF NOT EXISTS answer_counts_sanitize_before BEFORE INSERT ON sanitize
+BEGIN
+    {_counts.tally_query.format(sign="-", where="effective_responses.idx = new.idx")}
+END;
+
+CREATE TRIGGER IF NOT EXISTS answer_counts_sanitize AFTER INSERT ON sanitize
+BEGIN
+    {_counts.tally_query.format(sign="", where="effective_responses.idx = new.idx")}
+    {_drop_unused_counts.format(question="(SELECT question FROM responses WHERE idx = new.idx)")}
+END;
+
+CREATE TRIGGER IF NOT EXISTS answer_counts_unsanitize_before BEFORE DELETE ON sanitize
+BEGIN
+    {_counts.tally_query.format(sign="-", where="effective_responses.idx = old.idx")}
+END;
+
+CREATE TRIGGER IF NOT EXISTS answer_counts_unsanitize AFTER DELETE ON sanitize
+BEGIN
+    {_counts.tally_query.format(sign="", where="effective_responses.idx = old.idx")}
+    {_drop_unused_counts.format(question="(SELECT question FROM responses WHERE idx = old.idx)")}
+END;
+"""
+
+def _add_answer_counts(db):
+    _execute_script(db, answer_counts_schema)
+    _counts.rebuild(db)
+
+def _add_sanitize_claims(db):
+    # Responses a moderator is currently working on, so that others leave them alone until
+    # the claim is released or expires.
+    db.execute("""CREATE TABLE IF NOT EXISTS sanitize_claims
+                      (response_idx INTEGER PRIMARY KEY REFERENCES responses (idx) NOT NULL,
+                       moderator TEXT NOT NULL,
+                       expires INTEGER NOT NULL);""")
+    db.execute("CREATE INDEX IF NOT EXISTS sanitize_claims_moderator ON sanitize_claims (moderator);")
+
+# Full text index of the effective responses. It reads the values to highlight from the view
+# instead of keeping a copy of every response. External content is never read back to delete
+# an entry, so what was indexed is deleted before the view changes and the new value indexed
+# after.
+search_schema = """
+CREATE VIEW IF NOT EXISTS searchable_responses AS
+    SELECT idx, session, value FROM effective_responses WHERE value != '';
+
+CREATE VIRTUAL TABLE IF NOT EXISTS response_search
+    USING fts5(value, content='searchable_responses', content_rowid='idx');
+
+CREATE TRIGGER IF NOT EXISTS response_search_flags_before BEFORE UPDATE OF flags, value ON responses
+BEGIN
+    INSERT INTO response_search (response_search, rowid, value)
+        SELECT 'delete', idx, value FROM searchable_responses WHERE idx = old.idx;
+END;
+
+CREATE TRIGGER IF NOT EXISTS response_search_flags AFTER UPDATE OF flags, value ON responses
+BEGIN
+    INSERT INTO response_search (rowid, value) SELECT idx, value FROM searchable_responses WHERE idx = new.idx;
+END;
+
+CREATE TRIGGER IF NOT EXISTS response_search_sanitize_before BEFORE INSERT ON sanitize
+BEGIN
+    INSERT INTO response_search (response_search, rowid, value)
+        SELECT 'delete', idx, value FROM searchable_responses WHERE idx = new.idx;
+END;
+
+CREATE TRIGGER IF NOT EXISTS response_search_sanitize AFTER INSERT ON sanitize
+BEGIN
+    INSERT INTO response_search (rowid, value) SELECT idx, value FROM searchable_responses WHERE idx = new.idx;
+END;
+
+CREATE TRIGGER IF NOT EXISTS response_search_unsanitize_before BEFORE DELETE ON sanitize
+BEGIN
+    INSERT INTO response_search (response_search, rowid, value)
+        SELECT 'delete', idx, value FROM searchable_responses WHERE idx = old.idx;
+END;
+
+CREATE TRIGGER IF NOT EXISTS response_search_unsanitize AFTER DELETE ON sanitize
+BEGIN
+    INSERT INTO response_search (rowid, value) SELECT idx, value FROM searchable_responses WHERE idx = old.idx;
+END;
+"""
+
+def add_search_sessions(db, first_session):
+    """Indexes the responses of every session from `first_session` onward.
+
+    New responses aren't indexed by a trigger, update adds them all in one statement instead.
+    """
+    db.execute("INSERT INTO response_search (rowid, value) SELECT idx, value FROM searchable_responses WHERE session >= ?;",
+               (first_session,))
+
+def rebuild_search(db):
+    db.execute("INSERT INTO response_search (response_search) VALUES ('delete-all');")
+    add_search_sessions(db, 0)
+
+def _add_response_search(db):
+    # Everything needed to keep the index current on a sanitize is available to triggers, so
+    # every writer keeps it in sync for free. New responses are indexed in bulk by update.
+    _execute_script(db, search_schema)
+    add_search_sessions(db, 0)
+
+# Splits the effective values of the responses matching `{where}` into their trimmed ';'
+# separated choices.
+_response_items_insert = f"""
+    INSERT INTO response_items (response_idx, question, position, value)
+        SELECT effective_responses.idx, question, choices.key, {_counts.trimmed_choice}
+        FROM effective_responses, json_each({_counts.choices_json.format(value="effective_responses.value")}) AS choices
+        WHERE {{where}} AND {_counts.trimmed_choice} != '';"""
+
+response_items_schema = f"""
+CREATE TABLE IF NOT EXISTS response_items
+    (response_idx INTEGER REFERENCES responses (idx) NOT NULL,
+     question INTEGER REFERENCES questions (idx) NOT NULL,
+     position INTEGER NOT NULL,
+     value TEXT NOT NULL,
+     PRIMARY KEY (response_idx, position))
+WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS response_items_question ON response_items (question, value, response_idx);
+
+CREATE TRIGGER IF NOT EXISTS response_items_flags AFTER UPDATE OF flags ON responses
+BEGIN
+    DELETE FROM response_items WHERE response_idx = new.idx;
+    {_response_items_insert.format(where="effective_responses.idx = new.idx")}
+END;
+
+CREATE TRIGGER IF NOT EXISTS response_items_sanitize AFTER INSERT ON sanitize
+BEGIN
+    DELETE FROM response_items WHERE response_idx = new.idx;
+    {_response_items_insert.format(where="effective_responses.idx = new.idx")}
+END;
+
+CREATE TRIGGER IF NOT EXISTS response_items_unsanitize AFTER DELETE ON sanitize
+BEGIN
+    DELETE FROM response_items WHERE response_idx = old.idx;
+    {_response_items_insert.format(where="effective_responses.idx = old.idx")}
+END;
+"""
+
+def add_response_items_sessions(db, first_session):
+    """Splits the responses of every session from `first_session` onward into their choices.
+
+    New responses aren't split by a trigger, update adds them all in one statement instead.
+    """
+    where = "effective_responses.session >= ? AND effective_responses.value != ''"
+    db.execute(_response_items_insert.format(where=where), (first_session,))
+
+def rebuild_response_items(db):
+    db.execute("DELETE FROM response_items;")
+    add_response_items_sessions(db, 0)
+
+def _add_response_items(db):
+    # The multiple choice answers split into one row per choice, kept current by triggers on a
+    # sanitize and filled in bulk by update just like the search index.
+    _execute_script(db, response_items_schema)
+    rebuild_response_items(db)
+
+def _add_session_times(db):
+    # The timestamps parsed once into seconds since the epoch, indexed for bucketing them.
+    columns = [i[1] for i in db.execute("PRAGMA table_info(sessions);")]
+    if "submitted" not in columns:
+        db.execute("ALTER TABLE sessions ADD COLUMN submitted INTEGER;")
+    db.create_function("parse_timestamp", 1, parse_timestamp, deterministic=True)
+    db.execute("UPDATE sessions SET submitted = parse_timestamp(timestamp);")
+    db.execute("CREATE INDEX IF NOT EXISTS sessions_submitted ON sessions (submitted);")
+
+# Append only! The position in this list is the schema version the migration upgrades to.
+migrations = [
+    _create_tables,
+    _add_response_indexes,
+    _add_answer_counts,
+    _add_sanitize_claims,
+    _add_response_search,
+    _add_response_items,
+    _add_session_times,
+]
+
+def _get_version(db):
+    return db.execute("SELECT MAX(version) FROM schema_version;").fetchone()[0] or 0
+
+def check_version(db):
+    """Makes sure a db we can't upgrade, eg because it's read only, is already up to date"""
+    try:
+        version = _get_version(db)
+    except sqlite3.OperationalError:
+        version = 0
+    if version < len(migrations):
+        raise RuntimeError("The survey database is out of date, run a command without --read-only once to upgrade it")
+
+def upgrade(db):
+    db.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL);")
+    if _get_version(db) >= len(migrations):
+        return
+
+    with db:
+        # Take the write lock before checking again in case another command beat us to it.
+        db.execute("BEGIN IMMEDIATE;")
+        version = _get_version(db)
+        for i, migration in enumerate(migrations[version:], start=version + 1):
+            migration(db)
+            db.execute("INSERT INTO schema_version (version) VALUES (?);", (i,))
@@ -13,34 +13,172 @@
 #    You should have received a copy of the GNU General Public License
 #    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
 
+import _profile
+import atexit
+import calendar
 from contextlib import contextmanager
+import datetime
+from pathlib import Path
 import sqlite3
+import time
+
+# Rows pulled from SQLite per round trip by iter_results().
+fetch_batch_size = 512
+
+# Prepared statements kept around per connection, keyed by their SQL text.
+cached_statements = 256
+
+# Formats of the session timestamps, the first being what Google Sheets exports. The times are
+# taken to be UTC.
+timestamp_formats = ("%m/%d/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S")
+
+# Read only connections map this much of the db into memory instead of copying every page
+# they read out of the OS cache.
+mmap_size = 1 << 30
+
+# URI parameters of the read only modes. An immutable db is assumed to never change while
+# we're looking at it, so SQLite doesn't even take locks on it.
+_read_only_modes = { "ro": "mode=ro", "immutable": "mode=ro&immutable=1" }
+
+# One connection per database is shared by every command run in this process.
+_connections = {}
+
+def parse_timestamp(value):
+    """Seconds since the epoch of a session timestamp, or None if it can't be made sense of"""
+    for i in timestamp_formats:
+        try:
+            return calendar.timegm(datetime.datetime.strptime(value.strip(), i).timetuple())
+        except (ValueError, AttributeError):
+            continue
+    return None
+
+def _execute(cursor, query, args, kwargs):
+    if not _profile.enabled:
+        cursor.execute(query, *args, **kwargs)
+        return 0.0
+    start = time.perf_counter()
+    cursor.execute(query, *args, **kwargs)
+    return time.perf_counter() - start
+
+def _fetch(cursor, fetch, query, args, kwargs):
+    elapsed = _execute(cursor, query, args, kwargs)
+    if not _profile.enabled:
+        return fetch()
+    start = time.perf_counter()
+    results = fetch()
+    elapsed += time.perf_counter() - start
+    rows = len(results) if isinstance(results, list) else int(results is not None)
+    _profile.record_query(cursor.connection, query, args[0] if args else kwargs.get("parameters", ()),
+                          elapsed, rows)
+    return results
 
 def fetch_result(db, query, *args, **kwargs):
     cursor = db.cursor()
     try:
-        cursor.execute(query, *args, **kwargs)
-        return cursor.fetchone()
+        return _fetch(cursor, cursor.fetchone, query, args, kwargs)
     finally:
         cursor.close()
 
-def iter_results(db, query, *args, **kwargs):
+def fetch_column(db, query, *args, **kwargs):
+    """Returns the first column of every result as a list"""
     cursor = db.cursor()
     try:
-        cursor.execute(query, *args, **kwargs)
+        return [i[0] for i in _fetch(cursor, cursor.fetchall, query, args, kwargs)]
+    finally:
+        cursor.close()
+
+def fetch_mapping(db, query, *args, **kwargs):
+    """Returns a dict of the first column of every result to its second column"""
+    cursor = db.cursor()
+    try:
+        return dict(((i[0], i[1]) for i in _fetch(cursor, cursor.fetchall, query, args, kwargs)))
+    finally:
+        cursor.close()
+
+def iter_results(db, query, *args, batch_size=None, **kwargs):
+    cursor = db.cursor()
+    cursor.arraysize = batch_size or fetch_batch_size
+    profiling = _profile.enabled
+    elapsed, rows = 0.0, 0
+    try:
+        elapsed += _execute(cursor, query, args, kwargs)
         while True:
-            result = cursor.fetchone()
-            if result is None:
+            if profiling:
+                start = time.perf_counter()
+                results = cursor.fetchmany()
+                elapsed += time.perf_counter() - start
+                rows += len(results)
+            else:
+                results = cursor.fetchmany()
+            if not results:
                 break
-            yield result
+            yield from results
     finally:
         cursor.close()
+        if profiling:
+            _profile.record_query(db, query, args[0] if args else kwargs.get("parameters", ()),
+                                  elapsed, rows)
 
-@contextmanager
-def open_database(*args, **kwargs):
-    connection = sqlite3.connect(*args, **kwargs)
+def _connect(database, mode=None, **kwargs):
+    import _schema
+
+    kwargs.setdefault("cached_statements", cached_statements)
+    if mode is None:
+        connection = sqlite3.connect(database, **kwargs)
+    else:
+        uri = f"{Path(database).resolve().as_uri()}?{_read_only_modes[mode]}"
+        connection = sqlite3.connect(uri, uri=True, **kwargs)
     connection.row_factory = sqlite3.Row
     try:
-        yield connection
-    finally:
+        connection.execute("PRAGMA cache_size = -32768;")
+        connection.execute("PRAGMA temp_store = MEMORY;")
+        if mode is None:
+            _schema.upgrade(connection)
+        else:
+            connection.execute(f"PRAGMA mmap_size = {mmap_size};")
+            _schema.check_version(connection)
+    except:
+        connection.close()
+        raise
+    return connection
+
+@atexit.register
+def close_databases():
+    for connection in _connections.values():
         connection.close()
+    _connections.clear()
+
+def read_mode(args):
+    """The open_database() mode asked for by the --read-only and --immutable arguments"""
+    if args.immutable:
+        return "immutable"
+    if args.read_only:
+        return "ro"
+    return None
+
+def copy_to_memory(db):
+    """Copies the whole db into a new in memory connection, the caller has to close it"""
+    connection = sqlite3.connect(":memory:", cached_statements=cached_statements)
+    connection.row_factory = sqlite3.Row
+    try:
+        db.backup(connection)
+    except:
+        connection.close()
+        raise
+    return connection
+
+@contextmanager
+def open_database(database, mode=None, **kwargs):
+    """Opens the db, or read only with a mode of 'ro' or 'immutable'"""
+    key = (str(database), mode, tuple(sorted(kwargs.items())))
+    connection = _connections.get(key)
+    if connection is None:
+        connection = _connect(database, mode, **kwargs)
+        _connections[key] = connection
+    try:
+        yield connection
+    except:
+        # Don't leave a half done transaction behind for the next user of the connection.
+        if connection.in_transaction:
+            connection.rollback()
+        raise
@@ -0,0 +1,133 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import importlib
+import io
+import json
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from _profile import phase
+from _utils import *
+import _arguments
+import generate
+import graph
+import sanitize
+
+# Everything is generated from scratch, so the db doesn't have to exist yet.
+requires_valid_db = False
+
+# Share of the sessions appended to the survey for timing an incremental update.
+incremental_share = 0.01
+
+# Free text question whose moderation queue is timed.
+queue_question = 15
+
+def _run(argv):
+    """Runs a command in this process as if it was given on the command line"""
+    args = _arguments.main_parser.parse_args(argv)
+    module = importlib.import_module(args.command)
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.main(args)
+
+def _time(timings, name, func, *args):
+    print(f"    {name}...", end="", flush=True)
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    with phase(name):
+        func(*args)
+    wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    timings[name] = { "wall": wall, "cpu": cpu }
+    print(f" {wall:.3f}s")
+
+def _build_sanitize_queue(db_path):
+    with open_database(db_path) as db:
+        where = sanitize.queue_filter(sanitize.question_queue)
+        try:
+            sanitize.claim_batch(db, "benchmark", where, (queue_question,), -1)
+        finally:
+            sanitize.release_claims(db, "benchmark")
+
+def _benchmark_size(work_dir, sessions, args):
+    csv_path = work_dir.joinpath(f"survey_{sessions}.csv")
+    db_path = work_dir.joinpath(f"survey_{sessions}.db")
+    output = work_dir.joinpath(f"graphs_{sessions}")
+    db_path.unlink(missing_ok=True)
+    common = ["--db-path", str(db_path)]
+
+    print(f"Generating {sessions} sessions...")
+    appended = max(int(sessions * incremental_share), 1)
+    generate.write_survey(csv_path, sessions, seed=args.seed)
+
+    timings = {}
+    _time(timings, "update --full", _run, [*common, "update", "--full", str(csv_path)])
+    generate.write_survey(csv_path, appended, append=True, first_session=sessions, seed=args.seed)
+    _time(timings, "update", _run, [*common, "update", str(csv_path)])
+
+    for name in graph.graph_names():
+        path = output.joinpath(name).with_suffix(".html")
+        _time(timings, f"graph {name}", _run, [*common, "graph", "--output", str(path), name])
+    _time(timings, "graph all", _run, [*common, "graph", "--force", "--output", str(output), "all"])
+    _time(timings, "sanitize queue", _build_sanitize_queue, db_path)
+
+    # Let go of the db, so the next size doesn't have to share the page cache with it.
+    close_databases()
+    return { "sessions": sessions, "appended": appended, "timings": timings }
+
+def _git_revision():
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+def main(args):
+    try:
+        sizes = [int(i) for i in args.sizes.split(",")]
+    except ValueError:
+        raise RuntimeError("Sizes must be comma separated session counts!")
+
+    try:
+        # The graphs are timed without the one-off cost of importing plotly.
+        graph.import_plotting()
+    except ImportError as ex:
+        raise RuntimeError(f"{ex} -- did you install it?")
+
+    results = {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "sizes": [],
+    }
+    with contextlib.ExitStack() as stack:
+        work_dir = args.work_dir
+        if work_dir is None:
+            work_dir = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        work_dir.mkdir(parents=True, exist_ok=True)
+
+        try:
+            for sessions in sizes:
+                print(f"Benchmarking {sessions} sessions:")
+                results["sizes"].append(_benchmark_size(work_dir, sessions, args))
+        finally:
+            # Keep whatever was measured before an interruption.
+            with args.output.open("w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+            print(f"Results written to {args.output}")
@@ -0,0 +1,130 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+
+from _utils import *
+import _aggregate
+import _counts
+import _rules
+import _schema
+import response
+import sanitize
+
+# Signals to the main script to check the db for us.
+requires_valid_db = True
+
+def _hot_queries(db):
+    """The queries run by the other commands, taken from the modules running them.
+
+    None of these should have to walk a whole table to find their rows. The unfiltered graph
+    scan reads every response by design, so only its filtered form is checked.
+    """
+    source = _aggregate.DatabaseSource(db)
+    filtered = _aggregate.DatabaseSource(db, _aggregate.SessionFilter.parse(db, [(0, ""), (4, "")]))
+    in_sessions = source.in_sessions
+    claim_where = sanitize.queue_filter(sanitize.question_queue)
+    return {
+        "graph crosstab": (source.crosstab_query(2), (7, 4)),
+        "filtered graph crosstab": (filtered.crosstab_query(2), (7, 4)),
+        "filtered graph scan": (_aggregate.scan_query(filtered), ()),
+        "session filter": filtered.where.query,
+        "sessions per bucket": (_aggregate.session_timeline_query.format(in_sessions=in_sessions("idx")),
+                                { "size": 86400 }),
+        "choices per bucket": (_aggregate.choice_timeline_query.format(in_sessions=in_sessions("responses.session")),
+                               { "question": 0, "size": 86400 }),
+        "sanitize claim": (sanitize.claim_query.format(where=claim_where), ("", 0, 0, 0, 1)),
+        "sanitize claimed responses": (sanitize.claimed_query, ("",)),
+        "update answer counts": (_counts.tally_query.format(sign="", where=_counts.new_sessions_where), (0,)),
+        "update sanitize rules": (_rules.pending_query.format(questions="0, 4"), (0, 0)),
+        "session responses": (response.responses_query, { "session": 0, "question": -1 }),
+    }
+
+def iter_query_plan(db, query, *args, **kwargs):
+    for step in iter_results(db, f"EXPLAIN QUERY PLAN {query}", *args, **kwargs):
+        yield step["detail"]
+
+def _check_query_plans(db):
+    full_scans = []
+    for name, (query, params) in _hot_queries(db).items():
+        plan = list(iter_query_plan(db, query, params))
+        # Walking the rows of a subquery, of a CTE or of the choices json_each() split off one
+        # value is fine, they were already looked up.
+        materialized = { i.split()[1] for i in plan if i.startswith("MATERIALIZE") }
+        scans = [i for i in plan if i.startswith("SCAN") and not i.startswith("SCAN (") and
+                 "VIRTUAL TABLE" not in i and i.split()[1] not in materialized]
+        print(f"{name}: {'FULL SCAN' if scans else 'OK'}")
+        for step in plan:
+            print(f"    {step}")
+        if scans:
+            full_scans.append(name)
+    return full_scans
+
+def _check_answer_counts(db):
+    mismatches = list(_counts.iter_mismatches(db))
+    print(f"answer counts: {'STALE' if mismatches else 'OK'}")
+    for question, value, stored, live in mismatches:
+        print(f"    Q:{question} {value!r} stored (count, respondents) {stored}, actually {live}")
+    return bool(mismatches)
+
+def _check_response_items(db):
+    # The items and the counts are split by separate queries, so they keep each other honest.
+    q = """SELECT answer_counts.question, answer_counts.value, respondents, IFNULL(items, 0) AS items
+           FROM answer_counts
+           LEFT JOIN (SELECT question, value, COUNT(DISTINCT response_idx) AS items
+                      FROM response_items GROUP BY question, value) AS live
+                  ON live.question = answer_counts.question AND live.value = answer_counts.value
+           WHERE respondents != IFNULL(items, 0)
+           UNION ALL
+           SELECT question, value, 0, COUNT(DISTINCT response_idx)
+           FROM response_items
+           WHERE NOT EXISTS (SELECT 1 FROM answer_counts
+                             WHERE answer_counts.question = response_items.question AND
+                                   answer_counts.value = response_items.value)
+           GROUP BY question, value;"""
+    mismatches = list(iter_results(db, q))
+    print(f"response items: {'STALE' if mismatches else 'OK'}")
+    for question, value, respondents, items in mismatches:
+        print(f"    Q:{question} {value!r} chosen by {respondents} responses, {items} response items")
+    return bool(mismatches)
+
+def _check_search(db):
+    # The index doesn't keep a copy of the responses, so FTS5 can compare it to the view.
+    try:
+        db.execute("INSERT INTO response_search (response_search, rank) VALUES ('integrity-check', 1);")
+        stale = False
+    except sqlite3.DatabaseError:
+        stale = True
+    print(f"search index: {'STALE' if stale else 'OK'}")
+    return stale
+
+def main(args):
+    with open_database(args.db_path) as db:
+        if args.rebuild:
+            print("Rebuilding answer counts, search index and response items...")
+            with db:
+                _counts.rebuild(db)
+                _schema.rebuild_search(db)
+                _schema.rebuild_response_items(db)
+
+        full_scans = _check_query_plans(db)
+        stale_counts = _check_answer_counts(db)
+        stale_counts |= _check_response_items(db)
+        stale_counts |= _check_search(db)
+    if full_scans:
+        raise RuntimeError(f"Queries scanning whole tables: {', '.join(full_scans)}")
+    if stale_counts:
+        raise RuntimeError("Answer counts, response items or the search index are out of date, run check --rebuild")
+    return True
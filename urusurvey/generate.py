@@ -0,0 +1,121 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import datetime
+import random
+
+# Sessions are made up, so the db doesn't have to exist yet.
+requires_valid_db = False
+
+# Answers for the questions drawn by the graph subcommands, by question index. Every other
+# question is free text.
+survey_choices = {
+    0: ["English", "German", "French", "Dutch", "Spanish", "Italian", "Polish", "Russian", "Swedish"],
+    1: ["Yes", "Somewhat", "No"],
+    2: ["Yes", "No", "No preference"],
+    3: ["Yes", "Maybe", "No"],
+    4: ["Windows", "Mac", "Linux"],
+    5: ["Easy", "Moderate", "Hard", "Impossible"],
+    6: ["None", "Crashes", "Graphics glitches", "No sound"],
+    7: ["Wine", "CrossOver", "Boot Camp", "Virtual machine"],
+    8: ["MOULa", "Gehn", "TOC-MOUL", "Deep Island", "Minkata", "Open Cavern"],
+    9: ["Exploration", "Puzzles", "Community", "Fan Ages", "Story"],
+    10: ["DrizzleBot", "Sharper", "Kirel", "Mystitech"],
+    11: ["Yes", "No"],
+    12: ["Yes", "No", "Used to"],
+    13: ["Second Life", "Myst Online", "World of Warcraft", "Guild Wars 2", "Minecraft"],
+    14: ["URU", "Second Life", "Both equally"],
+    16: ["Yes", "No"],
+    18: ["Often", "Sometimes", "Never"],
+    24: ["Ahra Pahts", "Tiam", "Vothol Gallery", "Fehnir Herald", "Serene"],
+    25: ["Yes", "No", "Tried it"],
+    26: ["Yes", "No", "Maybe"],
+    27: ["3ds Max", "Blender", "PyPRP", "Korman", "Drizzle", "GIMP"],
+    28: ["Korman", "PyPRP", "3ds Max plugin", "Drizzle"],
+    30: ["Yes", "No"],
+    32: ["Yes", "No", "No preference"],
+    33: ["2.49", "2.79", "2.9x", "3.x", "Never"],
+    35: ["3ds Max 7", "3ds Max 2010", "3ds Max 2012", "3ds Max 2017", "3ds Max 2021"],
+    38: ["Multiplayer", "Physics", "Animations", "Documentation"],
+    41: ["Yes", "No"],
+}
+survey_multi_select = { 8, 10, 13, 27, 35 }
+survey_question_count = 44
+
+# Only Mac users get asked about playing on a Mac, Linux users share the question about
+# running the Windows client.
+_os_question = 4
+_conditional = { 5: {"Mac"}, 6: {"Mac"}, 7: {"Mac", "Linux"} }
+
+_start_time = datetime.datetime(2020, 5, 1)
+
+def _free_text(rng, question, cardinality):
+    value = f"Answer {rng.randrange(cardinality)} to {question}"
+    # Every so often, a variant that only differs by case or spacing like real people type.
+    if rng.random() < 0.05:
+        value = f" {value.lower()} "
+    return value
+
+def _answer(rng, question, row, multi_density, free_text_cardinality, empty_rate):
+    allowed = _conditional.get(question)
+    # The first column is the timestamp.
+    if allowed is not None and row[_os_question + 1] not in allowed:
+        return ""
+    if rng.random() < empty_rate:
+        return ""
+
+    choices = survey_choices.get(question)
+    if choices is None:
+        return _free_text(rng, question, free_text_cardinality)
+    if question in survey_multi_select:
+        picked = [i for i in choices if rng.random() < multi_density]
+        return ";".join(picked or [rng.choice(choices)])
+    return rng.choice(choices)
+
+def iter_sessions(sessions, first_session=0, seed=0, multi_density=0.3,
+                  free_text_cardinality=1000, empty_rate=0.1):
+    """Yields CSV rows, the same seed and first session always make the same rows"""
+    rng = random.Random(f"{seed}:{first_session}")
+    for i in range(first_session, first_session + sessions):
+        timestamp = _start_time + datetime.timedelta(seconds=37 * i)
+        row = [timestamp.strftime("%m/%d/%Y %H:%M:%S")]
+        for question in range(survey_question_count):
+            row.append(_answer(rng, question, row, multi_density, free_text_cardinality, empty_rate))
+        yield row
+
+def write_survey(path, sessions, append=False, first_session=0, **kwargs):
+    with path.open("a" if append else "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if not append:
+            writer.writerow(["Timestamp", *(f"Question {i}?" for i in range(survey_question_count))])
+        writer.writerows(iter_sessions(sessions, first_session, **kwargs))
+
+def _count_sessions(path):
+    with path.open("r", newline="", encoding="utf-8") as f:
+        return max(sum(1 for i in csv.reader(f) if i) - 1, 0)
+
+def main(args):
+    if not 0.0 <= args.empty_rate <= 1.0 or not 0.0 < args.multi_density <= 1.0:
+        raise RuntimeError("Rates must be between 0 and 1!")
+    if args.free_text_cardinality < 1:
+        raise RuntimeError("Free text cardinality must be at least 1!")
+
+    append = args.append and args.csv_path.is_file()
+    first_session = _count_sessions(args.csv_path) if append else 0
+    write_survey(args.csv_path, args.sessions, append, first_session, seed=args.seed,
+                 multi_density=args.multi_density, free_text_cardinality=args.free_text_cardinality,
+                 empty_rate=args.empty_rate)
+    print(f"Wrote sessions {first_session} to {first_session + args.sessions - 1} to {args.csv_path}")
@@ -14,36 +14,23 @@
 #    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import contextlib
+import copy
+import datetime
 import functools
+import hashlib
+import json
+from pathlib import Path
+import re
 
+from _aggregate import *
 from _constants import *
+from _profile import phase
 from _utils import *
 
 # Signals to the main script to check the db for us.
 requires_valid_db = True
 
-def _count_responses(db, question):
-    return sum((1 if i else 0 for i in _iter_responses(db, question)))
-
-def _iter_responses(db, question, split=None):
-    q = """SELECT flags,
-                  responses.value AS original,
-                  sanitize.value AS sanitized
-           FROM responses
-           LEFT JOIN sanitize ON sanitize.idx = responses.idx
-           WHERE question = ?;"""
-    for response in iter_results(db, q, (question,)):
-        if response["flags"] & ResponseFlags.sanitized:
-            value = response["sanitized"]
-        else:
-            value = response["original"]
-        if value:
-            if split is not None:
-                for i in value.split(split):
-                    yield i
-            else:
-                yield value
-
 def _output_fig(fig, output):
     import plotly.io
 
@@ -51,96 +38,125 @@ def _output_fig(fig, output):
         output.parent.mkdir(parents=True, exist_ok=True)
         if output.is_file():
             output.unlink()
-        plotly.io.write_html(fig, file=str(output), auto_open=False)
+        if output.suffix == ".json":
+            plotly.io.write_json(fig, str(output))
+        else:
+            # A stable div id keeps the output reproducible from run to run.
+            plotly.io.write_html(fig, file=str(output), auto_open=False, div_id=output.stem)
     else:
         plotly.io.show(fig)
 
-def _bar_graph_responses(db, output, question=-1, key="unknown", title="unknown"):
-    print("Collecting data...")
-    counter = collections.Counter()
-    counter.update(_iter_responses(db, question, split=';'))
-    response_count = _count_responses(db, question)
+class _Graph:
+    """A graph subcommand, split into collecting its data and building its figure.
+
+    The data is kept small and picklable so that the figure can be built elsewhere, eg in
+    another process.
+    """
+
+    def __init__(self, collect, figure, **params):
+        self._collect = collect
+        self._figure = figure
+        self.params = params
+
+    @property
+    def questions(self):
+        """Indices of the questions the graph is drawn from"""
+        if "question" in self.params:
+            return {self.params["question"]}
+        return set(self.params.get("questions", ()))
+
+    def noted(self, note):
+        """The same graph with `note` added to its title, eg to tell which sessions it covers"""
+        if not note:
+            return self
+        return _Graph(self._collect, self._figure, **self.params, note=note)
+
+    def collect(self, source):
+        return self._collect(source, **self.params)
+
+    def figure(self, data):
+        fig = self._figure(data, **self.params)
+        if self.params.get("note"):
+            fig.update_layout(title_text=f"{fig.layout.title.text} ({self.params['note']})")
+        return fig
+
+    def digest(self, data):
+        digest = hashlib.sha256(_code_version().encode("utf-8"))
+        digest.update(json.dumps(self.params, sort_keys=True).encode("utf-8"))
+        digest.update(json.dumps(data).encode("utf-8"))
+        return digest.hexdigest()
+
+    def __call__(self, source, args):
+        graph = self.noted(args.note)
+        print("Collecting data...")
+        with phase("collect"):
+            data = graph.collect(source)
+        print("Generating graph...")
+        _render_figure(graph, data, args.output)
+
+def _bar_graph_data(source, question=-1, key="unknown", **kwargs):
+    response_count = source.response_count(question)
     data = collections.OrderedDict()
-    for data_key, data_value in sorted(counter.items()):
+    for data_key, data_value in sorted(source.choice_counts(question).items()):
         data.setdefault(key, []).append(data_key)
         data.setdefault("Percent", []).append(round((data_value / response_count) * 100, 2))
         data.setdefault("Count", []).append(data_value)
+    return data
 
-    print("Generating graph...")
+def _bar_graph_figure(data, key="unknown", title="unknown", **kwargs):
     import pandas
     import plotly.express
 
     df = pandas.DataFrame(data)
     fig = plotly.express.bar(df, x=key, y="Percent", color="Percent", title=title,
                              hover_name=key, hover_data=["Count"])
-    _output_fig(fig, output)
+    return fig
 
-def _pie_chart_responses(db, output, question=-1, title="unknown"):
-    print("Collecting data...")
-    counter = collections.Counter()
-    counter.update(_iter_responses(db, question))
+def _pie_chart_data(source, question=-1, **kwargs):
+    return dict(sorted(source.value_counts(question).items()))
 
-    print("Generating graph...")
+def _pie_chart_figure(counter, title="unknown", **kwargs):
     import plotly.graph_objects as go
 
     fig = go.Figure(data=go.Pie(labels=list(counter.keys()),
                                 values=list(counter.values()),
                                 hole=0.3),
                     layout_title_text=title)
-    _output_fig(fig, output)
+    return fig
 
-def _sunburst_i10n(db, output):
-    print("Collecting data...")
+# (parent, child) question pairs tallied for the sunbursts
+_i10n_pairs = { "comfort": (0, 1), "prefer": (0, 2), "volunteer": (0, 3) }
+_os_pair = (4, 7)
+_all_pairs = (*_i10n_pairs.values(), _os_pair)
 
+def _sunburst_i10n_data(source, **kwargs):
     keys = ["language", "comfort", "prefer", "volunteer"]
-    def generate_data():
-        user = collections.namedtuple("user", keys)
-        q  = """SELECT language_response.flags AS language_flags,
-                       language_response.value AS language_original,
-                       language_sanitize.value AS language_sanitized,
-                       comfort_response.value AS comfort_value,
-                       prefer_response.value AS prefer_value,
-                       volunteer_response.value AS volunteer_value
-                FROM responses language_response
-                LEFT JOIN sanitize language_sanitize ON language_sanitize.idx = language_response.idx
-                LEFT JOIN responses comfort_response ON comfort_response.question = 1 AND
-                                                        comfort_response.session = language_response.session
-                LEFT JOIN responses prefer_response ON prefer_response.question = 2 AND
-                                                       prefer_response.session = language_response.session
-                LEFT JOIN responses volunteer_response ON volunteer_response.question = 3 AND
-                                                          volunteer_response.session = language_response.session
-                WHERE language_response.question = 0;"""
-        for result in iter_results(db, q):
-            if result["language_flags"] & ResponseFlags.sanitized:
-                language = result["language_sanitized"]
-            else:
-                language = result["language_original"]
-            if not language:
-                continue
-            yield user(language, result["comfort_value"], result["prefer_value"], result["volunteer_value"])
-
-    # Probably not the best idea to have all this in memory. Luckily the dataset is not that large.
-    # Ugh. What a mess.
-    data_src = list(generate_data())
-    counters = { key: collections.Counter(((i.language, getattr(i, key)) for i in data_src if getattr(i, key))) for key in keys }
-    languages = counters.pop("language")
-
-    data = collections.defaultdict(list)
+    languages = source.value_counts(_i10n_pairs["comfort"][0])
+    counters = { key: { (language, value): count
+                        for (language, value), count in source.pair_counts(*pair).items()
+                        if language and value }
+                 for key, pair in _i10n_pairs.items() }
+
+    # Sorted, as every source returns its counts in its own order. Every key is there even
+    # without any sessions, for the figure to look them up.
+    data = { f"{key}_{i}": [] for key in counters for i in ("ids", "labels", "values", "parents") }
     for key, counter in counters.items():
-        for (language, _), count in languages.items():
+        for language, count in sorted(languages.items()):
             data[f"{key}_ids"].append(language)
             data[f"{key}_labels"].append(language)
             data[f"{key}_values"].append(count)
             data[f"{key}_parents"].append("Native Language")
-        for (native_language, value), count in counter.items():
+        for (native_language, value), count in sorted(counter.items()):
             data[f"{key}_ids"].append(f"{native_language} - {value}")
             data[f"{key}_labels"].append(value)
             data[f"{key}_values"].append(count)
             data[f"{key}_parents"].append(native_language)
+    return data
 
-    print("Generating graph...")
+def _sunburst_i10n_figure(data, **kwargs):
     import plotly.graph_objects as go
 
+    keys = ["language", "comfort", "prefer", "volunteer"]
     buttons = []
     titles = {
         "comfort": "Comfortable Playing URU in English",
@@ -162,35 +178,17 @@ def _sunburst_i10n(db, output):
             fig.update_layout(title_text=titles[key])
     fig.update_layout(updatemenus=[go.layout.Updatemenu(type="buttons", direction="up",
                                                         active=0, buttons=buttons)])
-    _output_fig(fig, output)
-
-def _sunburst_os(db, output):
-    print("Collecting data...")
-
-    def generate_os_wrappers():
-        q = """SELECT os_response.value AS os,
-                      wrapper_response.flags AS wrapper_flags,
-                      wrapper_response.value AS wrapper_original,
-                      wrapper_sanitize.value AS wrapper_sanitized
-               FROM responses os_response
-               LEFT JOIN responses wrapper_response ON wrapper_response.question = 7 AND
-                                                       wrapper_response.session = os_response.session
-               LEFT JOIN sanitize wrapper_sanitize ON wrapper_sanitize.idx = wrapper_response.idx
-               WHERE os_response.question = 4;"""
-        for result in iter_results(db, q):
-            if result["wrapper_flags"] & ResponseFlags.sanitized:
-                wrapper = result["wrapper_sanitized"]
-            else:
-                wrapper = result["wrapper_original"]
-            yield result["os"], wrapper
-            # ensure we count this for the case of the OS in general as well.
-            if wrapper:
-                yield result["os"], ""
+    return fig
 
+def _sunburst_os_data(source, **kwargs):
     counter = collections.Counter()
-    counter.update(generate_os_wrappers())
+    for (os, wrapper), count in source.pair_counts(*_os_pair).items():
+        counter[os, wrapper] += count
+        # ensure we count this for the case of the OS in general as well.
+        if wrapper:
+            counter[os, ""] += count
     ids, labels, parents, values = [], [], [], []
-    for (os, wrapper), count in counter.items():
+    for (os, wrapper), count in sorted(counter.items()):
         if wrapper:
             ids.append(f"{os} - {wrapper}")
             labels.append(wrapper)
@@ -201,108 +199,450 @@ def _sunburst_os(db, output):
             labels.append(os)
             parents.append("Preferred OS")
             values.append(count)
+    return { "ids": ids, "labels": labels, "parents": parents, "values": values }
 
-    print("Generating graph...")
+def _sunburst_os_figure(data, **kwargs):
     import plotly.graph_objects as go
 
+    ids, labels, parents, values = data["ids"], data["labels"], data["parents"], data["values"]
     fig = go.Figure(data=go.Sunburst(ids=ids, labels=labels, parents=parents, values=values,
                                      branchvalues="total", hoverinfo="label+text+value+name+percent parent"),
                     layout_title_text="OS and Wrapper Usage")
-    _output_fig(fig, output)
+    return fig
+
+def _rollup(crosstab):
+    """Turns crosstab counts into (path, count) nodes with a subtotal for every level.
+
+    A path stops at the first level without an answer, so that session still counts towards
+    the levels above it.
+    """
+    nodes = collections.Counter()
+    for values, count in crosstab.items():
+        path = []
+        for value in values:
+            if not value:
+                break
+            path.append(value)
+            nodes[tuple(path)] += count
+    return sorted(nodes.items())
+
+def _crosstab_data(source, questions=(), **kwargs):
+    return [(list(path), count) for path, count in _rollup(source.crosstab(*questions))]
+
+def _crosstab_figure(nodes, title="unknown", **kwargs):
+    import plotly.graph_objects as go
+
+    ids = [" - ".join(path) for path, _ in nodes]
+    labels = [path[-1] for path, _ in nodes]
+    parents = [" - ".join(path[:-1]) for path, _ in nodes]
+    values = [count for _, count in nodes]
+    fig = go.Figure(data=go.Sunburst(ids=ids, labels=labels, parents=parents, values=values,
+                                     branchvalues="total", hoverinfo="label+text+value+name+percent parent"),
+                    layout_title_text=title)
+    return fig
+
+def _print_crosstab_table(nodes):
+    totals = { tuple(path): count for path, count in nodes }
+    grand_total = sum(count for path, count in nodes if len(path) == 1)
+    for path, count in nodes:
+        parent_total = totals[tuple(path[:-1])] if len(path) > 1 else grand_total
+        print(f"{'    ' * (len(path) - 1)}{path[-1]}: {count} ({count / parent_total:.1%})")
+
+def _crosstab(source, args):
+    if not args.questions:
+        raise RuntimeError("The questions to crosstab must be specified!")
+
+    title = " / ".join(source.question_text(i) for i in args.questions)
+    graph = _Graph(_crosstab_data, _crosstab_figure, questions=args.questions, title=title)
+    if args.table:
+        print(title)
+        _print_crosstab_table(graph.collect(source))
+    else:
+        graph(source, args)
+
+# Bucket sizes of the timelines in seconds
+_timeline_buckets = { "day": 24 * 60 * 60, "hour": 60 * 60 }
+
+# Most picked answers drawn on their own in an answer timeline, the rest are lumped together.
+_timeline_answers = 8
+
+def _bucket_time(bucket):
+    return datetime.datetime.fromtimestamp(bucket, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M")
+
+def _session_timeline_data(source, bucket="day", **kwargs):
+    counts = source.session_timeline(_timeline_buckets[bucket])
+    return { "Time": [_bucket_time(i) for i in sorted(counts)],
+             "Responses": [counts[i] for i in sorted(counts)] }
+
+def _session_timeline_figure(data, title="unknown", **kwargs):
+    import pandas
+    import plotly.express
+
+    df = pandas.DataFrame(data)
+    fig = plotly.express.bar(df, x="Time", y="Responses", title=title)
+    return fig
+
+def _answer_timeline_data(source, question=-1, bucket="day", **kwargs):
+    counts = source.choice_timeline(question, _timeline_buckets[bucket])
+    totals = collections.Counter()
+    for (_, value), count in counts.items():
+        totals[value] += count
+    shown = { value for value, _ in totals.most_common(_timeline_answers) }
+
+    combined = collections.Counter()
+    for (time, value), count in counts.items():
+        combined[time, value if value in shown else "Other"] += count
+
+    # Every answer needs a point in every bucket for the areas to stack up properly.
+    times = sorted({ time for time, _ in combined })
+    answers = sorted({ value for _, value in combined })
+    data = collections.OrderedDict((("Time", []), ("Answer", []), ("Count", [])))
+    for time in times:
+        for value in answers:
+            data["Time"].append(_bucket_time(time))
+            data["Answer"].append(value)
+            data["Count"].append(combined[time, value])
+    return data
+
+def _answer_timeline_figure(data, title="unknown", **kwargs):
+    import pandas
+    import plotly.express
+
+    df = pandas.DataFrame(data)
+    fig = plotly.express.area(df, x="Time", y="Count", color="Answer", groupnorm="percent",
+                              title=title, hover_data=["Count"])
+    return fig
+
+def _timeline(source, args):
+    if not args.questions or len(args.questions) != 1:
+        raise RuntimeError("The question to show over time must be specified!")
 
-def _print_help(db=None, output=None):
+    question = args.questions[0]
+    title = f"{source.question_text(question)} (Share per {args.bucket.title()})"
+    graph = _Graph(_answer_timeline_data, _answer_timeline_figure, question=question,
+                   bucket=args.bucket, title=title)
+    graph(source, args)
+
+def _print_help(source=None, args=None):
     options = ",".join(subcommands.keys())
     print(f"Graph commands: {options}")
 
-def _draw_all_graphs(db, output):
+def import_plotting():
+    """Imports everything the graphs are drawn with up front, eg once per render worker"""
+    import pandas
+    import plotly.express
+    import plotly.graph_objects
+    import plotly.io
+
+def _render_figure(graph, data, path):
+    with phase("figure"):
+        fig = graph.figure(data)
+    with phase("write"):
+        _output_fig(fig, path)
+
+def _render_graph(name, graph, data, path):
+    with phase(name, subcommand=True):
+        _render_figure(graph, data, path)
+
+@functools.lru_cache()
+def _code_version():
+    """Changes whenever the graph code or the plotly doing the rendering changes"""
+    import importlib.metadata
+
+    try:
+        plotly_version = importlib.metadata.version("plotly")
+    except importlib.metadata.PackageNotFoundError:
+        plotly_version = "unknown"
+    digest = hashlib.sha256(Path(__file__).read_bytes())
+    digest.update(plotly_version.encode("utf-8"))
+    return digest.hexdigest()
+
+def _render_cache_path(output):
+    return output.with_name(f"{output.name}.cache.json")
+
+def _render_cache_key(path):
+    # Both the html and the dashboard json of a graph may be in the output at once.
+    return path.name
+
+def _load_render_cache(path):
+    try:
+        with path.open("r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_render_cache(path, manifest):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+# Index page for the dashboard output of graph all. Every graph is a JSON file that is only
+# fetched and drawn once it is about to be scrolled into view.
+_dashboard_template = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+.graph {{ min-height: 450px; }}
+</style>
+</head>
+<body>
+{graphs}
+<script src="{plotlyjs}"></script>
+<script>
+const observer = new IntersectionObserver((entries) => {{
+    for (const entry of entries) {{
+        if (!entry.isIntersecting)
+            continue;
+        observer.unobserve(entry.target);
+        fetch(entry.target.dataset.src)
+            .then((response) => response.json())
+            .then((fig) => Plotly.newPlot(entry.target, fig.data, fig.layout, fig.config));
+    }}
+}}, {{ rootMargin: "200px" }});
+document.querySelectorAll(".graph").forEach((div) => observer.observe(div));
+</script>
+</body>
+</html>
+"""
+
+def plotlyjs_name():
+    import plotly.offline
+
+    # The bundle is named by version so that it is written once and can be cached forever.
+    return f"plotly-{plotly.offline.get_plotlyjs_version()}.min.js"
+
+def dashboard_index(names):
+    import html
+
+    graphs = "\n".join((f'<div class="graph" id="{html.escape(name)}" '
+                         f'data-src="{html.escape(name)}.json"></div>' for name in names))
+    return _dashboard_template.format(title="Uru Survey", plotlyjs=plotlyjs_name(), graphs=graphs)
+
+def _write_dashboard(output, names):
+    import plotly.offline
+
+    plotlyjs_path = output.joinpath(plotlyjs_name())
+    if not plotlyjs_path.is_file():
+        plotlyjs_path.write_text(plotly.offline.get_plotlyjs(), encoding="utf-8")
+    output.joinpath("index.html").write_text(dashboard_index(names), encoding="utf-8")
+    print(f"Outputing dashboard @ {output.joinpath('index.html')}")
+
+def _load_matrix(db, where=None):
+    from _matrix import ResponseMatrix
+
+    matrix = ResponseMatrix.load(db)
+    if where is not None:
+        matrix = matrix.filtered(matrix.where_all(where.conditions))
+    return matrix
+
+def load_all_graphs_source(db, matrix=False, where=None):
+    """Collects everything the graphs need in one go instead of a few queries per graph"""
+    if matrix:
+        return _load_matrix(db, where)
+    return Aggregates(db, pairs=_all_pairs, where=where)
+
+def _load_segment_sources(db, question, matrix=False, where=None):
+    """Sources of the sessions picking each answer to `question`, collected in a single pass"""
+    if matrix:
+        source = _load_matrix(db, where)
+        return { value: source.filtered(source.where_chose(question, value))
+                 for value in sorted(source.choice_counts(question)) }
+    return Aggregates.segmented(db, question, pairs=_all_pairs, where=where)
+
+def _draw_all_graphs(source, args):
+    output = args.output
     if not output:
         raise RuntimeError("Output path must be specified!")
 
-    for name, func in subcommands.items():
-        if name in {"help", "all"}:
-            continue
+    names = graph_names()
+    drawn = render_graphs(source, output, names, force=args.force, note=args.note,
+                          suffix=".json" if args.dashboard else ".html", jobs=args.jobs)
+    if args.dashboard:
+        output.mkdir(parents=True, exist_ok=True)
+        _write_dashboard(output, names)
+
+    print()
+    print(f"Render cache: {len(names) - len(drawn)} unchanged, {len(drawn)} rendered")
+
+def graph_names(questions=None):
+    """Names of the graphs drawn from any of `questions`, or of every graph when it's None.
+
+    Graphs that aren't drawn from any particular question, like the timelines, are always in.
+    """
+    return [name for name, graph in subcommands.items()
+            if isinstance(graph, _Graph) and
+               (questions is None or not graph.questions or graph.questions & questions)]
+
+def render_graphs(source, output, names=None, force=False, note=None, suffix=".html", jobs=1):
+    """Renders the graphs `names`, every graph by default, from `source` into the `output` directory.
+
+    Graphs whose data, parameters and code are unchanged since they were last written are
+    left alone. Returns the names of the graphs that were rendered.
+    """
+    cache_path = _render_cache_path(output)
+    manifest = {} if force else _load_render_cache(cache_path)
+    graphs = []
+    for name in graph_names() if names is None else names:
+        graph = subcommands[name].noted(note)
+        path = output.joinpath(name).with_suffix(suffix)
+        with phase(name, subcommand=True), phase("collect"):
+            data = graph.collect(source)
+        digest = graph.digest(data)
+        if manifest.get(_render_cache_key(path)) != digest or not path.is_file():
+            manifest.pop(_render_cache_key(path), None)
+            graphs.append((name, graph, data, path, digest))
 
-        path = output.joinpath(name).with_suffix(".html")
-        print()
-        print(f"Outputing '{name}' @ {path}")
-        func(db, path)
+    try:
+        if jobs <= 1:
+            for name, graph, data, path, digest in graphs:
+                print()
+                print(f"Outputing '{name}' @ {path}")
+                _render_graph(name, graph, data, path)
+                manifest[_render_cache_key(path)] = digest
+        elif graphs:
+            import concurrent.futures
+
+            print(f"Rendering {len(graphs)} graphs with {jobs} jobs...")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=import_plotting) as executor:
+                futures = [executor.submit(_render_graph, name, graph, data, path)
+                           for name, graph, data, path, digest in graphs]
+                # Report in submission order, regardless of which worker finishes first.
+                for (name, graph, data, path, digest), future in zip(graphs, futures):
+                    future.result()
+                    print(f"Outputing '{name}' @ {path}")
+                    manifest[_render_cache_key(path)] = digest
+    finally:
+        _save_render_cache(cache_path, manifest)
+    return [name for name, *_ in graphs]
 
 # Graphing subcommand handlers...
 subcommands = {
     "help": _print_help,
     "all": _draw_all_graphs,
+    "crosstab": _crosstab,
+    "timeline": _timeline,
+
+    # Timelines
+    "timeline_daily": _Graph(_session_timeline_data, _session_timeline_figure, bucket="day",
+                             title="Responses per Day"),
+    "timeline_hourly": _Graph(_session_timeline_data, _session_timeline_figure, bucket="hour",
+                              title="Responses per Hour"),
 
     # Sunbursts
-    "i10n": _sunburst_i10n,
-    "os_detail": _sunburst_os,
+    "i10n": _Graph(_sunburst_i10n_data, _sunburst_i10n_figure,
+                   questions=sorted({ i for pair in _i10n_pairs.values() for i in pair })),
+    "os_detail": _Graph(_sunburst_os_data, _sunburst_os_figure, questions=list(_os_pair)),
 
     # Simple bar graphs
-    "shards": functools.partial(_bar_graph_responses, question=8,
-                                key="Shard", title="Shards Played On"),
-    "bots": functools.partial(_bar_graph_responses, question=10,
-                              key="Bot", title="Bots Used"),
-    "online_games": functools.partial(_bar_graph_responses, question=13,
-                                      key="Game", title="Online Games Played"),
-    "tools_used": functools.partial(_bar_graph_responses, question=27,
-                                    key="Tool", title="Tools Used in Age Creation"),
-    "max_versions": functools.partial(_bar_graph_responses, question=35,
-                                      key="Version", title="Max Users: 3ds Max Versions"),
+    "shards": _Graph(_bar_graph_data, _bar_graph_figure, question=8,
+                     key="Shard", title="Shards Played On"),
+    "bots": _Graph(_bar_graph_data, _bar_graph_figure, question=10,
+                   key="Bot", title="Bots Used"),
+    "online_games": _Graph(_bar_graph_data, _bar_graph_figure, question=13,
+                           key="Game", title="Online Games Played"),
+    "tools_used": _Graph(_bar_graph_data, _bar_graph_figure, question=27,
+                         key="Tool", title="Tools Used in Age Creation"),
+    "max_versions": _Graph(_bar_graph_data, _bar_graph_figure, question=35,
+                           key="Version", title="Max Users: 3ds Max Versions"),
 
     # Simple pie charts
-    "language": functools.partial(_pie_chart_responses, question=0,
-                                  title="Native Language"),
-    "i10n_english": functools.partial(_pie_chart_responses, question=1,
-                                      title="Comfort Playing in English"),
-    "i10n_preference": functools.partial(_pie_chart_responses, question=2,
-                                         title="Prefer to Play in Native Language"),
-    "i10n_volunteer": functools.partial(_pie_chart_responses, question=3,
-                                        title="Willingness to Help Translate"),
-    "os": functools.partial(_pie_chart_responses, question=4, title="OS Preference"),
-    "mac_difficulty": functools.partial(_pie_chart_responses, question=5,
-                                        title="Mac Difficulty in Playing URU"),
-    "mac_problems": functools.partial(_pie_chart_responses, question=6,
-                                      title="Mac Problems When Playing URU"),
-    "mac_method": functools.partial(_pie_chart_responses, question=7,
-                                    title="Method Used to Play URU on Macs"),
-    "uru_favorite": functools.partial(_pie_chart_responses, question=9,
-                                      title="Favorite Aspect of Playing URU"),
-    "clients": functools.partial(_pie_chart_responses, question=11,
-                                 title="Nonstandard Client Usage"),
-    "sl": functools.partial(_pie_chart_responses, question=12,
-                            title="Second Life Players"),
-    "sl_or_uru": functools.partial(_pie_chart_responses, question=14,
-                                   title="Which Game is Played More Frequently"),
-    "sl_content_creation": functools.partial(_pie_chart_responses, question=16,
-                                             title="SL Content Creation"),
-    "uru_fan_visits": functools.partial(_pie_chart_responses, question=18,
-                                        title="URU Fan Content Usage"),
-    "uru_fan_age": functools.partial(_pie_chart_responses, question=24,
-                                     title="Favorite URU Fan Age"),
-    "uru_age_creation": functools.partial(_pie_chart_responses, question=25,
-                                          title="Fan Age Creation"),
-    "uru_fan_age_publish": functools.partial(_pie_chart_responses, question=26,
-                                             title="Interest in Seeing Their Content Online"),
-    "uru_favorite_tool": functools.partial(_pie_chart_responses, question=28,
-                                           title="Most Frequently Used Age Creation Tool"),
-    "max_experienced": functools.partial(_pie_chart_responses, question=30,
-                                         title="Used 3ds Max Before URU"),
-    "max_upgrade": functools.partial(_pie_chart_responses, question=32,
-                                     title="Wants an Update 3ds Max Plugin Binary"),
-    "max_blender_used": functools.partial(_pie_chart_responses, question=33,
-                                          title="3ds Max Users: Last Version of Blender Used"),
-    "korman_priority": functools.partial(_pie_chart_responses, question=38,
-                                         title="Korman Development Priority"),
-    "pyprp_new_blender": functools.partial(_pie_chart_responses, question=41,
-                                           title="PyPRP Users: Used a Newer Blender Version"),
+    "language": _Graph(_pie_chart_data, _pie_chart_figure, question=0,
+                       title="Native Language"),
+    "i10n_english": _Graph(_pie_chart_data, _pie_chart_figure, question=1,
+                           title="Comfort Playing in English"),
+    "i10n_preference": _Graph(_pie_chart_data, _pie_chart_figure, question=2,
+                              title="Prefer to Play in Native Language"),
+    "i10n_volunteer": _Graph(_pie_chart_data, _pie_chart_figure, question=3,
+                             title="Willingness to Help Translate"),
+    "os": _Graph(_pie_chart_data, _pie_chart_figure, question=4, title="OS Preference"),
+    "mac_difficulty": _Graph(_pie_chart_data, _pie_chart_figure, question=5,
+                             title="Mac Difficulty in Playing URU"),
+    "mac_problems": _Graph(_pie_chart_data, _pie_chart_figure, question=6,
+                           title="Mac Problems When Playing URU"),
+    "mac_method": _Graph(_pie_chart_data, _pie_chart_figure, question=7,
+                         title="Method Used to Play URU on Macs"),
+    "uru_favorite": _Graph(_pie_chart_data, _pie_chart_figure, question=9,
+                           title="Favorite Aspect of Playing URU"),
+    "clients": _Graph(_pie_chart_data, _pie_chart_figure, question=11,
+                      title="Nonstandard Client Usage"),
+    "sl": _Graph(_pie_chart_data, _pie_chart_figure, question=12,
+                 title="Second Life Players"),
+    "sl_or_uru": _Graph(_pie_chart_data, _pie_chart_figure, question=14,
+                        title="Which Game is Played More Frequently"),
+    "sl_content_creation": _Graph(_pie_chart_data, _pie_chart_figure, question=16,
+                                  title="SL Content Creation"),
+    "uru_fan_visits": _Graph(_pie_chart_data, _pie_chart_figure, question=18,
+                             title="URU Fan Content Usage"),
+    "uru_fan_age": _Graph(_pie_chart_data, _pie_chart_figure, question=24,
+                          title="Favorite URU Fan Age"),
+    "uru_age_creation": _Graph(_pie_chart_data, _pie_chart_figure, question=25,
+                               title="Fan Age Creation"),
+    "uru_fan_age_publish": _Graph(_pie_chart_data, _pie_chart_figure, question=26,
+                                  title="Interest in Seeing Their Content Online"),
+    "uru_favorite_tool": _Graph(_pie_chart_data, _pie_chart_figure, question=28,
+                                title="Most Frequently Used Age Creation Tool"),
+    "max_experienced": _Graph(_pie_chart_data, _pie_chart_figure, question=30,
+                              title="Used 3ds Max Before URU"),
+    "max_upgrade": _Graph(_pie_chart_data, _pie_chart_figure, question=32,
+                          title="Wants an Update 3ds Max Plugin Binary"),
+    "max_blender_used": _Graph(_pie_chart_data, _pie_chart_figure, question=33,
+                               title="3ds Max Users: Last Version of Blender Used"),
+    "korman_priority": _Graph(_pie_chart_data, _pie_chart_figure, question=38,
+                              title="Korman Development Priority"),
+    "pyprp_new_blender": _Graph(_pie_chart_data, _pie_chart_figure, question=41,
+                                title="PyPRP Users: Used a Newer Blender Version"),
 }
 
+def _segment_output(output, question, value, directory):
+    slug = re.sub(r"[^\w.-]+", "_", value).strip("_") or "blank"
+    if directory:
+        return output.joinpath(f"q{question}_{slug}")
+    return output.with_name(f"{output.stem}_q{question}_{slug}{output.suffix}")
+
+def _draw(subcommand, db, args):
+    where = SessionFilter.parse(db, args.where) if args.where else None
+    if where is not None and where.empty():
+        raise RuntimeError(f"no sessions match {where}")
+    draw_all = subcommand is _draw_all_graphs
+    if args.segment is None:
+        args.note = str(where) if where else None
+        if draw_all:
+            print("Collecting data for all graphs...")
+            with phase("aggregate"):
+                source = load_all_graphs_source(db, args.matrix, where)
+        else:
+            source = DatabaseSource(db, where)
+        subcommand(source, args)
+        return
+
+    if not args.output:
+        raise RuntimeError("Output path must be specified!")
+    print(f"Collecting data for every answer to question {args.segment}...")
+    with phase("aggregate"):
+        segments = _load_segment_sources(db, args.segment, args.matrix, where)
+    notes = [str(where)] if where else []
+    for value, source in segments.items():
+        segment_args = copy.copy(args)
+        segment_args.note = ", ".join((*notes, f"Q{args.segment}: {value}"))
+        segment_args.output = _segment_output(args.output, args.segment, value, draw_all)
+        print()
+        print(f"Drawing the sessions answering {value!r}...")
+        subcommand(source, segment_args)
+
 def main(args):
     try:
         subcommand = subcommands.get(args.subcommand)
         if subcommand is None:
             _print_help()
             return
-        with open_database(args.db_path) as db:
-            subcommand(db, args.output)
+        with open_database(args.db_path, read_mode(args)) as db:
+            if args.snapshot:
+                # Nothing but the backup touches the file, so a bulk run does its I/O in one go.
+                with contextlib.closing(copy_to_memory(db)) as snapshot:
+                    _draw(subcommand, snapshot, args)
+            else:
+                _draw(subcommand, db, args)
     except ImportError as ex:
         raise RuntimeError(f"{ex} -- did you install it?")
@@ -0,0 +1,62 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import itertools
+import statistics
+import time
+import urllib.error
+import urllib.request
+
+import graph
+
+# Only talks to a running serve command, the db is none of our business.
+requires_valid_db = False
+
+def _fetch(url):
+    start_time = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url) as response:
+            response.read()
+        ok = True
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return ok, time.perf_counter() - start_time
+
+def _percentile(latencies, percent):
+    return latencies[min(int(len(latencies) * percent / 100), len(latencies) - 1)]
+
+def main(args):
+    if args.requests < 1 or args.concurrency < 1:
+        raise RuntimeError("Requests and concurrency must be at least 1!")
+
+    paths = args.paths or [f"{name}.json" for name in graph.graph_names()]
+    base_url = args.url.rstrip("/")
+    urls = [f"{base_url}/{i.lstrip('/')}" for i in itertools.islice(itertools.cycle(paths), args.requests)]
+
+    print(f"Sending {len(urls)} requests for {len(paths)} paths with {args.concurrency} clients...")
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(_fetch, urls))
+    elapsed = time.perf_counter() - start_time
+
+    latencies = sorted(latency * 1000 for ok, latency in results if ok)
+    errors = len(results) - len(latencies)
+    print(f"Completed {len(latencies)} requests in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} requests/sec), "
+          f"{errors} failed")
+    if latencies:
+        print(f"Latency: mean {statistics.fmean(latencies):.1f}ms, p50 {_percentile(latencies, 50):.1f}ms, "
+              f"p95 {_percentile(latencies, 95):.1f}ms, p99 {_percentile(latencies, 99):.1f}ms, "
+              f"max {latencies[-1]:.1f}ms")
@@ -19,7 +19,7 @@ from _utils import *
 requires_valid_db = True
 
 def main(args):
-    with open_database(args.db_path) as db:
+    with open_database(args.db_path, read_mode(args)) as db:
         print("These are the questions by index:")
         for result in iter_results(db, "SELECT * FROM questions"):
             print(f"{result[0]}: {result[1]}")
@@ -19,34 +19,35 @@ from _utils import *
 # Signals to the main script to check the db for us.
 requires_valid_db = True
 
-def _print_response(db, session, question):
-    response = fetch_result(db, """SELECT flags,
-                                          responses.value AS original,
-                                          sanitize.value AS sanitized
-                                   FROM responses
-                                   LEFT JOIN sanitize ON sanitize.idx = responses.idx
-                                   WHERE session = ? AND question = ?""",
-                            (session, question))
-    if response is None:
-        raise RuntimeError(f"Could not get response from session {session}")
-    if not (response["flags"] & ResponseFlags.sanitized) and not response["original"]:
-        return
-    question_result = fetch_result(db, "SELECT value FROM questions WHERE idx = ?", (question,))
-    if question_result is None:
-        raise RuntimeError(f"Could not get question {question}")
+responses_query = """SELECT responses.question AS question_idx,
+                            questions.value AS question,
+                            flags,
+                            responses.value AS original,
+                            sanitize.value AS sanitized
+                     FROM responses
+                     LEFT JOIN sanitize ON sanitize.idx = responses.idx
+                     LEFT JOIN questions ON questions.idx = responses.question
+                     WHERE session = :session AND (:question < 0 OR responses.question = :question)
+                     ORDER BY responses.question;"""
+
+def _print_responses(db, session, question=-1):
+    found = False
+    for response in iter_results(db, responses_query, { "session": session, "question": question }):
+        found = True
+        if not (response["flags"] & ResponseFlags.sanitized) and not response["original"]:
+            continue
+        if response["question"] is None:
+            raise RuntimeError(f"Could not get question {response['question_idx']}")
 
-    print(f"QUESTION: {question_result[0]}")
-    print(f"RESPONSE: {response['original']}")
-    if response["flags"] & ResponseFlags.sanitized:
-        print(f"SANITIZE: {response['sanitized']}")
-    print()
+        print(f"QUESTION: {response['question']}")
+        print(f"RESPONSE: {response['original']}")
+        if response["flags"] & ResponseFlags.sanitized:
+            print(f"SANITIZE: {response['sanitized']}")
+        print()
+    if not found:
+        raise RuntimeError(f"Could not get response from session {session}")
 
 def main(args):
-    with open_database(args.db_path) as db:
-        if args.question == -1:
-            question_ids = tuple(iter_results(db, "SELECT idx FROM questions"))
-            for i in question_ids:
-                _print_response(db, args.session, i[0])
-        else:
-            _print_response(db, args.session, args.question)
-    return True
\ No newline at end of file
+    with open_database(args.db_path, read_mode(args)) as db:
+        _print_responses(db, args.session, args.question)
+    return True
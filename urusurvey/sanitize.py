@@ -13,66 +13,377 @@
 #    You should have received a copy of the GNU General Public License
 #    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import getpass
+import os
+import socket
+import threading
+import time
+
 from _constants import *
 from _utils import *
+import _cluster
+import _counts
+import _rules
 
 # Signals to the main script to check the db for us.
 requires_valid_db = True
 
-def _sanitize_by_question(db, i, show_all=False):
-    responses = iter_results(db, "SELECT idx FROM responses WHERE question = ?", (i,))
-    if responses is None:
-        raise RuntimeError(f"Unable to find responses to question {i}")
-
-    for j, response in enumerate(response[0] for response in responses):
-        _sanitize_response(db, response, print_question=(j==0), show_all=show_all)
-
-def _sanitize_by_session(db, i, show_all=False):
-    responses = iter_results(db, "SELECT idx FROM responses WHERE session = ?", (i,))
-    if responses is None:
-        raise RuntimeError(f"Unable to find responses to session {i}")
-
-    for response in responses:
-        _sanitize_response(db, response[0], show_all=show_all)
-
-def _sanitize_response(db, i, **kwargs):
-    response = fetch_result(db, """SELECT responses.idx AS response_idx,
-                                          responses.session AS session_idx,
-                                          responses.question AS question_idx,
-                                          flags,
-                                          responses.value AS original,
-                                          sanitize.value AS sanitized,
-                                          questions.value AS question
-                                   FROM responses
-                                   LEFT JOIN sanitize ON sanitize.idx = responses.idx
-                                   LEFT JOIN questions ON questions.idx = responses.question
-                                   WHERE responses.idx = ?;""", (i,))
-    if response is None:
-        raise RuntimeError(f"Unable to find response id {i}")
+# Confirmed decisions are committed in batches, whichever of these limits is reached first.
+commit_every_items = 25
+commit_every_seconds = 5.0
 
-    been_sanitized = response["flags"] & ResponseFlags.sanitized
-    valid_response = response["flags"] & ResponseFlags.valid
-    if not (kwargs.get("show_all", False) or kwargs.get("force", False)) and \
-           (been_sanitized or valid_response):
-        return
+# Moderators claim this many responses at a time. A claim that is neither released nor
+# renewed within claim_seconds is up for grabs again.
+claim_batch_size = 25
+claim_seconds = 15 * 60
+busy_timeout_ms = 30000
+
+_response_query = """SELECT responses.idx AS response_idx,
+                            responses.session AS session_idx,
+                            responses.question AS question_idx,
+                            flags,
+                            responses.value AS original,
+                            sanitize.value AS sanitized,
+                            questions.value AS question
+                     FROM responses
+                     LEFT JOIN sanitize ON sanitize.idx = responses.idx
+                     LEFT JOIN questions ON questions.idx = responses.question
+                     WHERE {where};"""
+
+claim_query = """INSERT INTO sanitize_claims (response_idx, moderator, expires)
+                 SELECT idx, ?, ? FROM responses
+                 WHERE {where} AND
+                       responses.idx > ? AND
+                       responses.idx NOT IN (SELECT response_idx FROM sanitize_claims)
+                 ORDER BY responses.idx
+                 LIMIT ?;"""
+
+claimed_query = _response_query.format(where="""responses.idx IN (SELECT response_idx FROM sanitize_claims
+                                                                  WHERE moderator = ?)
+                                                ORDER BY responses.idx""")
+
+# The queues of responses to a question and of a session.
+question_queue = "responses.question = ?"
+session_queue = "responses.session = ?"
+
+# Returned by the prompts when the moderator skips a response or a group of them.
+_skip = object()
+# Returned by a prompt command to ask the moderator again, eg after an empty value.
+_retry = object()
+# Returned by the cluster suggestion prompt to take every remaining suggestion as is.
+_accept_all = object()
 
+def _default_moderator():
+    return f"{getpass.getuser()}@{socket.gethostname()}:{os.getpid()}"
+
+def claim_batch(db, moderator, where, params, after):
+    """Claims the next batch of responses past `after` that nobody else is working on"""
+    now = int(time.time())
+    with db:
+        # Take the write lock up front so two moderators can't claim the same responses.
+        db.execute("BEGIN IMMEDIATE;")
+        db.execute("DELETE FROM sanitize_claims WHERE expires < ?;", (now,))
+        db.execute(claim_query.format(where=where),
+                   (moderator, now + claim_seconds, *params, after, claim_batch_size))
+    return list(iter_results(db, claimed_query, (moderator,)))
+
+def _renew_claims(db, moderator):
+    db.execute("UPDATE sanitize_claims SET expires = ? WHERE moderator = ?;",
+               (int(time.time()) + claim_seconds, moderator))
+
+def release_claims(db, moderator):
+    """Lets others work on whatever `moderator` claimed"""
+    with db:
+        db.execute("DELETE FROM sanitize_claims WHERE moderator = ?;", (moderator,))
+
+def queue_filter(where, show_all=False):
+    """Narrows a queue, eg question_queue, down to the responses a moderator should look at"""
+    if not show_all:
+        where = f"{where} AND responses.flags & {int(ResponseFlags.sanitized | ResponseFlags.valid)} = 0"
     # Probably shouldn't obey show_all because these are dead answers?
-    if not kwargs.get("force", False) and not response["original"]:
-        return
+    return f"{where} AND responses.value != ''"
+
+class _Decisions:
+    """Decisions waiting to be written in one short transaction.
+
+    They are flushed once there are commit_every_items of them, or by a timer once the oldest
+    is commit_every_seconds old, even if the moderator is still sitting at a prompt. The lock
+    is held by whoever uses the connection, as the timer flushes from its own thread.
+    """
 
+    def __init__(self, db, moderator):
+        self.db = db
+        self.moderator = moderator
+        self.lock = threading.RLock()
+        self.stats = collections.Counter()
+        self._pending = []
+        self._timer = None
+
+    def __bool__(self):
+        return bool(self._pending)
+
+    def append(self, response, sanitized):
+        with self.lock:
+            self._pending.append((response, sanitized))
+            if len(self._pending) >= commit_every_items:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(commit_every_seconds, self._flush_on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_on_timer(self):
+        with self.lock:
+            # A flush may have beaten us to it while we waited for the lock.
+            if self._timer is threading.current_thread():
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+            with self.db:
+                # Nothing is written while the moderator is deciding, so no lock is held across a prompt.
+                self.db.execute("BEGIN IMMEDIATE;")
+                for response, sanitized in self._pending:
+                    if not _write_decision(self.db, response, sanitized):
+                        self.stats["conflicts"] += 1
+                    elif sanitized is None:
+                        self.stats["verified"] += 1
+                    elif sanitized is False:
+                        self.stats["undone"] += 1
+                    else:
+                        self.stats["sanitized" if sanitized else "discarded"] += 1
+                _renew_claims(self.db, self.moderator)
+            self._pending.clear()
+
+def _sanitize_queue(db, moderator, where, params, show_all=False, print_question=False):
+    where = queue_filter(where, show_all)
+
+    decisions = _Decisions(db, moderator)
+    stats = decisions.stats
+    start_time = time.monotonic()
+    last_response = -1
+    try:
+        while True:
+            with decisions.lock:
+                batch = claim_batch(db, moderator, where, params, last_response)
+            if not batch:
+                break
+
+            for response in batch:
+                last_response = response["response_idx"]
+                first = not stats and not decisions
+                sanitized = _prompt_response(response, print_question=(print_question or first))
+                if sanitized is _skip:
+                    with decisions.lock:
+                        stats["skipped"] += 1
+                    continue
+                decisions.append(response, sanitized)
+            # Others may claim these responses once they are released.
+            with decisions.lock:
+                decisions.flush()
+                release_claims(db, moderator)
+    finally:
+        # Whatever happens, don't lose what the moderator already decided.
+        with decisions.lock:
+            decisions.flush()
+            release_claims(db, moderator)
+
+        elapsed = time.monotonic() - start_time
+        items = sum(stats.values())
+        print()
+        print(f"Moderated {items} responses in {elapsed:.0f}s ({items / max(elapsed / 60, 1e-9):.1f} items/minute): "
+              f"{stats['sanitized']} sanitized, {stats['discarded']} discarded, {stats['verified']} verified, "
+              f"{stats['undone']} undone, {stats['skipped']} skipped, "
+              f"{stats['conflicts']} changed by another moderator")
+
+def _sanitize_by_question(db, moderator, i, show_all=False):
+    _sanitize_queue(db, moderator, question_queue, (i,), show_all)
+
+def _sanitize_by_session(db, moderator, i, show_all=False):
+    _sanitize_queue(db, moderator, session_queue, (i,), show_all, print_question=True)
+
+def _enter_value(error):
+    print("Enter the new response value:")
+    value = input("> ").strip()
+    if not value:
+        print(error)
+        return _retry
+    return value
+
+def _prompt(question, commands, show):
+    """Shows the item being moderated with `show` and asks `question` until the moderator picks
+    one of `commands`.
+
+    `commands` maps each key to its help text and a function returning the decision, or _retry
+    to show the item and ask again.
+    """
     print_help = False
     while True:
         if print_help:
-            print("s - manually enter a sanitized response")
-            print("d - discard this response (shortcut for setting an empty sanitize)")
-            print("v - verify this as a valid response and don't show it again")
-            print("u - undo all sanitization actions")
-            print("n - nothing, skip over this and wait until later...")
+            for key, (text, _) in commands.items():
+                print(f"{key} - {text}")
             print("? - shows this help")
             print("SIGINT - save and exit")
             print()
             print_help = False
 
+        show()
+        print()
+
+        cmd = input(f"{question} [{','.join(commands)},?] ").lower().strip()
+        if cmd not in commands:
+            print_help = True
+            continue
+        decision = commands[cmd][1]()
+        if decision is not _retry:
+            return decision
+
+def _normalize(value):
+    return " ".join(value.casefold().split())
+
+# Responses to a question that nobody has looked at yet, narrowed down to one normalized value.
+_pending_group_filter = """question = :question AND
+                           flags & :handled = 0 AND
+                           value != '' AND
+                           normalize(value) = :normalized"""
+
+def _sanitize_by_group(db, i):
+    db.create_function("normalize", 1, _normalize, deterministic=True)
+    question = fetch_result(db, "SELECT value FROM questions WHERE idx = ?;", (i,))
+    if question is None:
+        raise RuntimeError(f"Unable to find question {i}")
+
+    # Collapse the pending responses into their distinct normalized values, most common first.
+    groups = collections.defaultdict(collections.Counter)
+    q = """SELECT normalize(value) AS normalized, value, COUNT(*) AS count
+           FROM responses
+           WHERE question = ? AND flags & ? = 0 AND value != ''
+           GROUP BY value;"""
+    for result in iter_results(db, q, (i, ResponseFlags.sanitized | ResponseFlags.valid)):
+        groups[result["normalized"]][result["value"]] += result["count"]
+    groups = sorted(groups.items(), key=lambda x: (-sum(x[1].values()), x[0]))
+
+    print(f"QUESTION: {question[0]}")
+    print(f"{sum(sum(i.values()) for _, i in groups)} pending responses in {len(groups)} groups")
+    print()
+
+    commands = {
+        "s": ("manually enter a sanitized response for the whole group",
+              lambda: _enter_value("Error: no value entered, use 'd' to discard.")),
+        "d": ("discard every response in the group", lambda: ""),
+        "v": ("verify the group as valid responses and don't show them again", lambda: None),
+        "n": ("nothing, skip over this group and wait until later...", lambda: _skip),
+    }
+    for j, (normalized, variants) in enumerate(groups):
+        def show():
+            print(f"G:{j + 1}/{len(groups)} Q:{i} {sum(variants.values())} responses")
+            for value, value_count in variants.most_common():
+                print(f"RESPONSE: {value} ({value_count})")
+
+        sanitized = _prompt("What should we do with these responses?", commands, show)
+        if sanitized is _skip:
+            continue
+
+        params = { "question": i, "handled": ResponseFlags.sanitized | ResponseFlags.valid,
+                   "normalized": normalized, "sanitized": sanitized }
+        with db:
+            if sanitized is None:
+                db.execute(f"UPDATE responses SET flags = flags | {int(ResponseFlags.valid)} "
+                           f"WHERE {_pending_group_filter};", params)
+            else:
+                db.execute(f"""INSERT INTO sanitize (idx, value)
+                               SELECT idx, :sanitized FROM responses WHERE {_pending_group_filter};""", params)
+                db.execute(f"UPDATE responses SET flags = flags | {int(ResponseFlags.sanitized)} "
+                           f"WHERE {_pending_group_filter};", params)
+
+def _replace_choices(value, choices, canonical):
+    """Rewrites the ';' separated choices of `value` that are in `choices` to `canonical`"""
+    # Don't list the canonical choice twice when the response has several of the spellings.
+    listed = canonical in _counts.split_choices(value)
+    result = []
+    for piece in value.split(";"):
+        if piece.strip(" \t\r\n") in choices:
+            if listed:
+                continue
+            piece, listed = canonical, True
+        result.append(piece)
+    return ";".join(result)
+
+def _apply_cluster(db, question, canonical, members):
+    """Rewrites every choice of `question` that is one of `members` to `canonical`, leaving the
+    other choices of the same responses alone.
+    """
+    choices = { i for i in members if i != canonical }
+    if not choices:
+        return
+    q = f"""SELECT DISTINCT responses.idx, flags, responses.value AS original, sanitize.value AS sanitized
+            FROM response_items
+            JOIN responses ON responses.idx = response_items.response_idx
+            LEFT JOIN sanitize ON sanitize.idx = responses.idx
+            WHERE response_items.question = ? AND response_items.value IN ({", ".join("?" * len(choices))});"""
+    with db:
+        for response in list(iter_results(db, q, (question, *choices))):
+            value = _counts.effective_value(response["flags"], response["original"], response["sanitized"])
+            sanitized = _replace_choices(value, choices, canonical)
+            db.execute("INSERT INTO sanitize (idx, value) VALUES (?, ?);", (response["idx"], sanitized))
+            db.execute(f"UPDATE responses SET flags = flags | {int(ResponseFlags.sanitized)} WHERE idx = ?;",
+                       (response["idx"],))
+
+def _suggest_clusters(db, i):
+    question = fetch_result(db, "SELECT value FROM questions WHERE idx = ?;", (i,))
+    if question is None:
+        raise RuntimeError(f"Unable to find question {i}")
+
+    print("Clustering responses...")
+    # The choices of multiple choice answers are clustered one by one, not as whole answers.
+    q = """SELECT value, COUNT(DISTINCT response_idx)
+           FROM response_items
+           WHERE question = ?
+           GROUP BY value;"""
+    clusters = _cluster.cluster_values(fetch_mapping(db, q, (i,)))
+    print(f"QUESTION: {question[0]}")
+    print(f"{len(clusters)} groups of similar responses found")
+    print()
+
+    accept_all = False
+    for j, (canonical, members) in enumerate(clusters):
+        if not accept_all:
+            def show():
+                print(f"G:{j + 1}/{len(clusters)} Q:{i} {sum(members.values())} responses")
+                print(f"SUGGEST:  {canonical}")
+                for value, count in sorted(members.items(), key=lambda x: (-x[1], x[0])):
+                    print(f"RESPONSE: {value} ({count})")
+
+            commands = {
+                "y": ("yes, sanitize every response in the group to the suggested value", lambda: canonical),
+                "e": ("enter a different value for the whole group",
+                      lambda: _enter_value("Error: no value entered.")),
+                "a": ("accept this and all of the remaining suggestions", lambda: _accept_all),
+                "n": ("no, leave these responses alone", lambda: _skip),
+            }
+            decision = _prompt("Should these responses be merged?", commands, show)
+            if decision is _skip:
+                continue
+            if decision is _accept_all:
+                accept_all = True
+            else:
+                canonical = decision
+        _apply_cluster(db, i, canonical, members)
+
+def _prompt_response(response, **kwargs):
+    """Asks the moderator what to do with `response`.
+
+    Returns the sanitized value, None to verify the response, False to undo all sanitization
+    or _skip.
+    """
+    been_sanitized = response["flags"] & ResponseFlags.sanitized
+    def show():
         print(f"S:{response['session_idx']} Q:{response['question_idx']} R:{response['response_idx']}")
         if kwargs.get("print_question", True):
             print(f"QUESTION: {response['question']}")
@@ -80,55 +391,84 @@ def _sanitize_response(db, i, **kwargs):
             print(f"RESPONSE: {response['original']}")
         if kwargs.get("print_sanitized", True) and been_sanitized:
             print(f"SANITIZE: {response['sanitized']}")
-        print()
 
-        cmd = input("What should we do with this response? [s,d,v,u,n,?] ").lower().strip()
-        if cmd == "s":
-            print("Enter the new response value:")
-            sanitized = input("> ").strip()
-            if not sanitized:
-                print("Error: no value entered, use 'd' to discard.")
-                continue
-            break
-        elif cmd == "d":
-            sanitized = ""
-            break
-        elif cmd == "v":
-            sanitized = None
-            break
-        elif cmd == "u":
-            sanitized = False
-            break
-        elif cmd == "n":
-            return
-        else:
-            print_help = True
-            continue
+    commands = {
+        "s": ("manually enter a sanitized response",
+              lambda: _enter_value("Error: no value entered, use 'd' to discard.")),
+        "d": ("discard this response (shortcut for setting an empty sanitize)", lambda: ""),
+        "v": ("verify this as a valid response and don't show it again", lambda: None),
+        "u": ("undo all sanitization actions", lambda: False),
+        "n": ("nothing, skip over this and wait until later...", lambda: _skip),
+    }
+    return _prompt("What should we do with this response?", commands, show)
 
-    with db:
-        if sanitized is None:
-            # This response is valid, mark that in the database.
-            flags = response["flags"] | ResponseFlags.valid
-        elif sanitized is False:
-            flags = ResponseFlags.none
-            db.execute("DELETE FROM sanitize WHERE idx = ?;", (response["response_idx"],))
-        else:
-            # We have a sanitized response to add...
-            flags = response["flags"] | ResponseFlags.sanitized
-            db.execute("INSERT INTO sanitize (idx, value) VALUES (?, ?);",
-                       (response["response_idx"], sanitized))
-        db.execute("UPDATE responses SET flags = ? WHERE idx = ?;", (flags, response["response_idx"]))
+def _write_decision(db, response, sanitized):
+    """Writes the moderator's decision, returning False if someone else changed the response since
+    it was read.
+    """
+    if sanitized is None:
+        flags = response["flags"] | ResponseFlags.valid
+    elif sanitized is False:
+        flags = ResponseFlags.none
+    else:
+        flags = response["flags"] | ResponseFlags.sanitized
+
+    # Optimistic concurrency: the flags and values must still be what we showed the moderator.
+    # Sanitizing an already sanitized response keeps its flags, so the flags alone won't do.
+    cursor = db.execute("""UPDATE responses SET flags = :flags
+                           WHERE idx = :idx AND
+                                 flags = :shown_flags AND
+                                 value = :shown_original AND
+                                 (SELECT value FROM sanitize WHERE idx = :idx) IS :shown_sanitized;""",
+                        { "flags": flags, "idx": response["response_idx"], "shown_flags": response["flags"],
+                          "shown_original": response["original"], "shown_sanitized": response["sanitized"] })
+    if cursor.rowcount == 0:
+        print(f"Response {response['response_idx']} was changed by another moderator, skipping it.")
+        return False
+
+    # A valid response is already fully marked by its flags.
+    if sanitized is False:
+        db.execute("DELETE FROM sanitize WHERE idx = ?;", (response["response_idx"],))
+    elif sanitized is not None:
+        # We have a sanitized response to add...
+        db.execute("INSERT INTO sanitize (idx, value) VALUES (?, ?);",
+                   (response["response_idx"], sanitized))
+    return True
+
+def _sanitize_response(db, i):
+    response = fetch_result(db, _response_query.format(where="responses.idx = ?"), (i,))
+    if response is None:
+        raise RuntimeError(f"Unable to find response id {i}")
+
+    sanitized = _prompt_response(response)
+    if sanitized is not _skip:
+        with db:
+            _write_decision(db, response, sanitized)
 
 def main(args):
     try:
-        with open_database(args.db_path) as db:
-            if args.question:
-                _sanitize_by_question(db, args.index, args.all)
+        # The decisions of a queue are flushed by a timer thread as well.
+        with open_database(args.db_path, check_same_thread=False) as db:
+            # Several moderators may be at work, wait for each other instead of failing.
+            db.execute("PRAGMA journal_mode = WAL;")
+            db.execute("PRAGMA synchronous = NORMAL;")
+            db.execute(f"PRAGMA busy_timeout = {busy_timeout_ms};")
+            moderator = args.moderator or _default_moderator()
+            if args.rules:
+                rules = _rules.load_rules(args.rules)
+                with db:
+                    _rules.print_changes(_rules.apply_rules(db, rules, dry_run=args.dry_run))
+            elif args.suggest:
+                _suggest_clusters(db, args.index)
+            elif args.question and args.group:
+                _sanitize_by_group(db, args.index)
+            elif args.question:
+                _sanitize_by_question(db, moderator, args.index, args.all)
             elif args.session:
-                _sanitize_by_session(db, args.index, args.all)
+                _sanitize_by_session(db, moderator, args.index, args.all)
             elif args.index >= 0:
-                _sanitize_response(db, args.index, force=True)
+                _sanitize_response(db, args.index)
             else:
                 raise RuntimeError("No sanitize mode was set!")
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, EOFError):
         print()
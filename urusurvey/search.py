@@ -0,0 +1,68 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import time
+
+from _constants import *
+from _utils import *
+
+# Signals to the main script to check the db for us.
+requires_valid_db = True
+
+def _flags_filter(args):
+    handled = int(ResponseFlags.sanitized | ResponseFlags.valid)
+    filters = []
+    if args.sanitized:
+        filters.append(f"flags & {int(ResponseFlags.sanitized)}")
+    if args.valid:
+        filters.append(f"flags & {int(ResponseFlags.valid)}")
+    if args.pending:
+        filters.append(f"flags & {handled} = 0")
+    if not filters:
+        return ""
+    return f"AND ({' OR '.join(filters)})"
+
+def main(args):
+    q = f"""SELECT responses.idx AS response_idx,
+                   session,
+                   question,
+                   flags,
+                   highlight(response_search, 0, '[', ']') AS value
+            FROM response_search
+            JOIN responses ON responses.idx = response_search.rowid
+            WHERE response_search MATCH :match
+                  {"AND question = :question" if args.question >= 0 else ""}
+                  {_flags_filter(args)}
+            ORDER BY rank
+            LIMIT :limit;"""
+
+    with open_database(args.db_path) as db:
+        start_time = time.perf_counter()
+        try:
+            results = list(iter_results(db, q, { "match": args.match, "question": args.question,
+                                                 "limit": args.limit }))
+        except sqlite3.OperationalError as ex:
+            raise RuntimeError(f"Invalid search '{args.match}': {ex}")
+        elapsed = time.perf_counter() - start_time
+
+    for result in results:
+        flags = ResponseFlags(result["flags"])
+        print(f"S:{result['session']} Q:{result['question']} R:{result['response_idx']} "
+              f"[{flags.name if flags else 'pending'}]")
+        print(f"RESPONSE: {result['value']}")
+        print()
+    print(f"Found {len(results)} responses in {elapsed * 1000:.1f}ms")
+    return True
@@ -0,0 +1,145 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import http
+import http.server
+import threading
+import time
+import urllib.parse
+
+from _utils import *
+import graph
+
+# Signals to the main script to check the db for us.
+requires_valid_db = True
+
+class _LiveGraphs:
+    """Keeps the aggregates of every graph warm, recollecting them only when the db changes"""
+
+    def __init__(self, db, db_path):
+        self.db = db
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.names = graph.graph_names()
+        self._version = None
+        self._source = None
+        self._data = {}
+        self._rendered = {}
+
+    def _db_version(self):
+        # data_version only notices commits from other connections, which is everyone but us.
+        # The mtime catches the file being replaced wholesale.
+        data_version = fetch_result(self.db, "PRAGMA data_version;")[0]
+        return (data_version, self.db_path.stat().st_mtime_ns)
+
+    def refresh(self):
+        version = self._db_version()
+        if version != self._version:
+            start_time = time.perf_counter()
+            self._source = graph.load_all_graphs_source(self.db)
+            self._data.clear()
+            self._version = version
+            print(f"Collected data for {len(self.names)} graphs in {time.perf_counter() - start_time:.3f}s")
+
+    def render(self, name, kind):
+        """Returns the ETag and body of a graph, only drawing it again if its data changed"""
+        self.refresh()
+        subcommand = graph.subcommands[name]
+        data = self._data.get(name)
+        if data is None:
+            data = subcommand.collect(self._source)
+            self._data[name] = data
+        digest = subcommand.digest(data)
+
+        rendered = self._rendered.get((name, kind))
+        if rendered is None or rendered[0] != digest:
+            fig = subcommand.figure(data)
+            if kind == "json":
+                body = fig.to_json()
+            else:
+                body = fig.to_html(include_plotlyjs=graph.plotlyjs_name(), div_id=name)
+            rendered = (digest, body.encode("utf-8"))
+            self._rendered[name, kind] = rendered
+        return rendered
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    content_types = { "html": "text/html; charset=utf-8", "json": "application/json" }
+
+    def do_GET(self):
+        live = self.server.live
+        path = urllib.parse.urlsplit(self.path).path.strip("/")
+        try:
+            if not path or path == "index.html":
+                self._send(http.HTTPStatus.OK, "html", graph.dashboard_index(live.names))
+            elif path == graph.plotlyjs_name():
+                import plotly.offline
+                self._send(http.HTTPStatus.OK, "application/javascript", plotly.offline.get_plotlyjs(),
+                           cache_control="public, max-age=31536000, immutable")
+            else:
+                name, _, kind = path.partition(".")
+                kind = kind or "html"
+                if name not in live.names or kind not in self.content_types:
+                    self._send(http.HTTPStatus.NOT_FOUND, "text/plain", f"No graph named '{path}'")
+                    return
+                with live.lock:
+                    digest, body = live.render(name, kind)
+                etag = f'"{digest}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self._send(http.HTTPStatus.NOT_MODIFIED, kind, b"", etag=etag)
+                else:
+                    self._send(http.HTTPStatus.OK, kind, body, etag=etag)
+        except Exception as ex:
+            self._send(http.HTTPStatus.INTERNAL_SERVER_ERROR, "text/plain", str(ex))
+            raise
+
+    def _send(self, status, content_type, body, etag=None, cache_control="no-cache"):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", self.content_types.get(content_type, content_type))
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", cache_control)
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def main(args):
+    try:
+        # Everything heavy is paid for once, before the first request comes in.
+        graph.import_plotting()
+    except ImportError as ex:
+        raise RuntimeError(f"{ex} -- did you install it?")
+
+    # Requests are handled in threads, but the connection is only ever used under the lock.
+    with open_database(args.db_path, check_same_thread=False) as db:
+        live = _LiveGraphs(db, args.db_path)
+        with live.lock:
+            live.refresh()
+
+        server = http.server.ThreadingHTTPServer((args.host, args.port), _RequestHandler)
+        server.live = live
+        server.verbose = args.verbose
+        print(f"Serving graphs @ http://{args.host}:{server.server_port}/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print()
+        finally:
+            server.server_close()
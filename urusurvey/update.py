@@ -14,68 +14,206 @@
 #    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
 
 import csv
-from _utils import open_database
-
-db_schema = """
-CREATE TABLE IF NOT EXISTS responses
-    (idx INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE ON CONFLICT IGNORE NOT NULL,
-     session INTEGER REFERENCES sessions (idx) NOT NULL,
-     question INTEGER REFERENCES questions (idx) NOT NULL,
-     flags INTEGER NOT NULL DEFAULT (0),
-     value TEXT NOT NULL,
-     CONSTRAINT user_response_constraint UNIQUE (session, question) ON CONFLICT IGNORE);
-
-CREATE TABLE IF NOT EXISTS questions
-     (idx INTEGER PRIMARY KEY ON CONFLICT IGNORE AUTOINCREMENT NOT NULL,
-      value TEXT);
-
-CREATE TABLE IF NOT EXISTS sanitize
-    (idx INTEGER PRIMARY KEY ON CONFLICT REPLACE AUTOINCREMENT REFERENCES responses (idx) NOT NULL, 
-     value TEXT NOT NULL);
-
-CREATE TABLE IF NOT EXISTS sessions
-    (idx INTEGER PRIMARY KEY ON CONFLICT IGNORE AUTOINCREMENT NOT NULL,
-     timestamp DATETIME NOT NULL);
-"""
+import hashlib
+import time
+from _profile import phase
+from _utils import *
+import _counts
+import _rules
+import _schema
+
+# Number of CSV rows buffered before each executemany() round trip.
+import_batch_size = 2000
+
+# How much of the start and the end of the already imported part of the CSV is hashed to
+# detect that rows we have seen before were changed. Bounded so that a refresh does not
+# have to reread the whole file.
+import_hash_window = 1 << 16
+
+class _TrackedLines:
+    """Feeds lines to csv.reader while keeping track of the byte offset consumed so far"""
+
+    def __init__(self, csv_file):
+        self._file = csv_file
+        self.offset = csv_file.tell()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self._file.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode("utf-8")
+
+def _hash_prefix(csv_file, offset):
+    csv_file.seek(0, 2)
+    if csv_file.tell() < offset:
+        return None
+
+    digest = hashlib.sha256(str(offset).encode("ascii"))
+    csv_file.seek(0)
+    digest.update(csv_file.read(min(offset, import_hash_window)))
+    if offset > import_hash_window:
+        csv_file.seek(max(offset - import_hash_window, import_hash_window))
+        digest.update(csv_file.read(offset - csv_file.tell()))
+    return digest.hexdigest()
+
+def _tune_for_import(db):
+    # The whole import is one transaction, so we trade durability of the in-flight
+    # import for not waiting on an fsync per statement.
+    db.execute("PRAGMA journal_mode = WAL;")
+    db.execute("PRAGMA synchronous = NORMAL;")
+    db.execute("PRAGMA cache_size = -65536;")
+    db.execute("PRAGMA temp_store = MEMORY;")
 
 def _import_questions(db, questions):
     # First column is timestamp
     questions_iter = iter(questions)
     next(questions_iter)
 
-    for i, question in enumerate(questions_iter):
-        with db:
-            db.execute("INSERT INTO questions (idx) VALUES (:idx);", { "idx": i })
-            db.execute("UPDATE questions SET value = :question WHERE idx = :idx;",
-                       { "idx": i, "question": question })
+    db.executemany("""INSERT INTO questions (idx, value) VALUES (?, ?)
+                      ON CONFLICT (idx) DO UPDATE SET value = excluded.value;""",
+                   enumerate(questions_iter))
 
-def _import_response(db, i, response):
-    # First column is timestamp
-    response_iter = iter(response)
-    timestamp = next(response_iter)
+def _flush_responses(db, sessions, responses, reimport=False):
+    if reimport:
+        db.executemany("""INSERT INTO sessions (idx, timestamp, submitted) VALUES (?, ?, ?)
+                          ON CONFLICT (idx) DO UPDATE SET timestamp = excluded.timestamp,
+                                                          submitted = excluded.submitted;""", sessions)
+        db.executemany("INSERT INTO temp.imported_responses (session, question, value) VALUES (?, ?, ?);",
+                       responses)
+    else:
+        db.executemany("INSERT INTO sessions (idx, timestamp, submitted) VALUES (?, ?, ?);", sessions)
+        db.executemany("INSERT INTO responses (session, question, value) VALUES (?, ?, ?);", responses)
+    sessions.clear()
+    responses.clear()
+
+def _merge_responses(db):
+    """Replaces the responses whose value changed with the staged ones, returning how many did.
+
+    A changed response is a new answer, so whatever a moderator decided about the old one
+    doesn't apply anymore.
+    """
+    changed = """SELECT responses.idx
+                 FROM responses
+                 JOIN temp.imported_responses AS imported ON imported.session = responses.session AND
+                                                             imported.question = responses.question
+                 WHERE responses.value != imported.value"""
+    db.execute(f"DELETE FROM sanitize WHERE idx IN ({changed});")
+    count = db.execute("""UPDATE responses SET value = imported.value, flags = 0
+                          FROM temp.imported_responses AS imported
+                          WHERE imported.session = responses.session AND
+                                imported.question = responses.question AND
+                                responses.value != imported.value;""").rowcount
+    db.execute("""INSERT INTO responses (session, question, value)
+                  SELECT session, question, value FROM temp.imported_responses ORDER BY session, question;""")
+    db.execute("DROP TABLE temp.imported_responses;")
+    return count
+
+def _import_responses(db, rows, first_session=0, reimport=False):
+    sessions, responses = [], []
+    i = first_session
+    for response in rows:
+        # Blank lines, such as the line break preceding rows appended after our last import.
+        if not response:
+            continue
 
-    with db:
-        db.execute("INSERT INTO sessions (idx, timestamp) VALUES (:idx, :timestamp);",
-                   { "idx": i, "timestamp": timestamp })
-        results = ((i, q, v.strip()) for q, v in enumerate(response_iter))
-        db.executemany("INSERT INTO responses (session, question, value) VALUES (?, ?, ?)", results)
+        # First column is timestamp
+        response_iter = iter(response)
+        timestamp = next(response_iter)
+        sessions.append((i, timestamp, parse_timestamp(timestamp)))
+        responses.extend(((i, q, v.strip()) for q, v in enumerate(response_iter)))
+        i += 1
+        if len(sessions) >= import_batch_size:
+            _flush_responses(db, sessions, responses, reimport)
+    _flush_responses(db, sessions, responses, reimport)
+    return i
+
+def _get_import_state(db, header_hash, csv_file):
+    state = fetch_result(db, "SELECT rows, offset, header_hash, prefix_hash FROM import_state;")
+    if state is None:
+        return None
+    if state["header_hash"] != header_hash:
+        print("The survey questions have changed, performing a full import...")
+        return None
+    if state["prefix_hash"] != _hash_prefix(csv_file, state["offset"]):
+        print("Previously imported responses have changed, performing a full import...")
+        return None
+    return state
+
+def _set_import_state(db, rows, offset, header_hash, csv_file):
+    db.execute("""INSERT INTO import_state (idx, rows, offset, header_hash, prefix_hash)
+                  VALUES (0, ?, ?, ?, ?)
+                  ON CONFLICT (idx) DO UPDATE SET rows = excluded.rows,
+                                                  offset = excluded.offset,
+                                                  header_hash = excluded.header_hash,
+                                                  prefix_hash = excluded.prefix_hash;""",
+               (rows, offset, header_hash, _hash_prefix(csv_file, offset)))
 
 def main(args):
     if not args.csv_path.is_file():
         print("Error: CSV file does not exist")
         return False
 
+    rules = _rules.load_rules(args.rules) if args.rules else {}
     with open_database(args.db_path) as db:
-        with db:
-            db.executescript(db_schema)
+        _tune_for_import(db)
 
-        with args.csv_path.open(encoding="utf-8") as csv_file:
-            csv_reader = csv.reader(csv_file)
+        start_time = time.perf_counter()
+        with args.csv_path.open("rb") as csv_file:
+            lines = _TrackedLines(csv_file)
+            csv_reader = csv.reader(lines)
 
             # First line contains the questions, so we'll handle it first.
-            _import_questions(db, next(csv_reader))
-            for i, response in enumerate(csv_reader):
-                _import_response(db, i, response)
+            questions = next(csv_reader)
+            header_hash = hashlib.sha256("\x1f".join(questions).encode("utf-8")).hexdigest()
+            header_offset = lines.offset
+
+            state = None if args.full else _get_import_state(db, header_hash, csv_file)
+            if state is None:
+                first_session, offset = 0, header_offset
+            else:
+                first_session, offset = state["rows"], state["offset"]
+            csv_file.seek(offset)
+            lines = _TrackedLines(csv_file)
+
+            with db:
+                new_session = fetch_result(db, "SELECT IFNULL(MAX(idx) + 1, 0) FROM sessions;")[0]
+                # Going over sessions we already have means something in them may have changed.
+                reimport = first_session < new_session
+                with phase("import"):
+                    _import_questions(db, questions)
+                    if reimport:
+                        db.execute("""CREATE TEMP TABLE imported_responses
+                                          (session INTEGER NOT NULL,
+                                           question INTEGER NOT NULL,
+                                           value TEXT NOT NULL);""")
+                    last_session = _import_responses(db, csv.reader(lines), first_session, reimport)
+                    if reimport:
+                        changed = _merge_responses(db)
+                with phase("counts"):
+                    if reimport:
+                        # New responses of old sessions aren't counted or indexed, so start over.
+                        _counts.rebuild(db)
+                        _schema.rebuild_search(db)
+                        _schema.rebuild_response_items(db)
+                    else:
+                        _counts.add_sessions(db, new_session)
+                        _schema.add_search_sessions(db, new_session)
+                        _schema.add_response_items_sessions(db, new_session)
+                # Known typos in the new responses are fixed without bothering a moderator.
+                with phase("rules"):
+                    changes = _rules.apply_rules(db, rules, min(first_session, new_session))
+                _set_import_state(db, last_session, lines.offset, header_hash, csv_file)
+        elapsed = time.perf_counter() - start_time
+        row_count = last_session - first_session
 
+    if reimport:
+        print(f"Reimported {row_count} rows, {changed} previously imported responses changed")
+    if rules:
+        print(f"Sanitize rules handled {sum(changes.values())} new responses")
+    print(f"Processed {row_count} rows in {elapsed:.2f}s ({row_count / max(elapsed, 1e-9):.0f} rows/sec)")
     print("Successfully updated survey database!")
     return True
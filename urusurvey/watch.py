@@ -0,0 +1,103 @@
+#    This file is part of UruSurvey
+#
+#    UruSurvey is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    UruSurvey is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with UruSurvey.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import hashlib
+import time
+
+from _aggregate import *
+from _profile import phase
+from _utils import *
+import graph
+import update
+
+# Signals to the main script to check the db for us.
+requires_valid_db = True
+
+def _question_digests(db):
+    """Digests of the answer counts of every question, to tell which ones an update touched"""
+    digests = {}
+    question, digest = None, None
+    q = "SELECT question, value, count, respondents FROM answer_counts ORDER BY question, value;"
+    for result in iter_results(db, q):
+        if result["question"] != question:
+            question = result["question"]
+            digest = hashlib.sha256()
+            digests[question] = digest
+        digest.update(f"{result['value']}\x1f{result['count']}\x1f{result['respondents']}\x1e".encode("utf-8"))
+    return { question: digest.hexdigest() for question, digest in digests.items() }
+
+def _stat(path):
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+def _redraw(db, output, questions=None):
+    """Redraws the graphs drawn from any of `questions`, or every graph when it's None.
+
+    They are only redrawn if their data changed, like with graph all.
+    """
+    return graph.render_graphs(DatabaseSource(db), output, graph.graph_names(questions))
+
+def _refresh(db, args, changed_at):
+    update_args = argparse.Namespace(db_path=args.db_path, csv_path=args.csv_path, rules=args.rules, full=False)
+    before = _question_digests(db)
+    with phase("update"):
+        update.main(update_args)
+    after = _question_digests(db)
+    questions = { i for i in before.keys() | after.keys() if before.get(i) != after.get(i) }
+
+    with phase("redraw"):
+        drawn = _redraw(db, args.output, questions)
+    print(f"Answers to {len(questions)} questions changed, redrew {len(drawn)} graphs: {', '.join(drawn) or 'none'}")
+    print(f"Refreshed {time.perf_counter() - changed_at:.2f}s after the CSV changed")
+
+def main(args):
+    if not args.output:
+        raise RuntimeError("Output path must be specified!")
+
+    try:
+        graph.import_plotting()
+    except ImportError as ex:
+        raise RuntimeError(f"{ex} -- did you install it?")
+
+    with open_database(args.db_path) as db:
+        # Catch up with whatever happened while nobody was watching.
+        print("Drawing graphs that are out of date...")
+        drawn = _redraw(db, args.output)
+        print(f"Redrew {len(drawn)} graphs")
+
+        print(f"Watching {args.csv_path} for changes, press Ctrl+C to stop...")
+        last_stat = _stat(args.csv_path)
+        changed_at, settled_at = None, None
+        try:
+            while True:
+                time.sleep(args.interval)
+                stat = _stat(args.csv_path)
+                now = time.perf_counter()
+                if stat != last_stat:
+                    # Wait for a burst of writes to settle before importing half of it.
+                    last_stat = stat
+                    if changed_at is None:
+                        changed_at = now
+                    settled_at = now + args.debounce
+                elif changed_at is not None and now >= settled_at and stat is not None:
+                    print()
+                    _refresh(db, args, changed_at)
+                    changed_at = None
+        except KeyboardInterrupt:
+            print()